@@ -2,15 +2,25 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
 import re
 import os.path
 import argparse
 import requests
+import sqlite3
+import threading
+import time
 import uuid
 import shutil
 
+BATCH_SIZE = 50  # the maximum number of items in mediaItems.batchCreate/batchGet
+# baseUrl links expire after approximately 60 minutes.
+# https://developers.google.com/photos/library/guides/best-practices?hl=en#caching
+BASE_URL_TTL = 50 * 60
+IMAGE_SIZE = "=w2048-h1024"
+
 
 def download_image(file_name, url):
     """Downloads an image from a URL and saves it to a file."""
@@ -26,28 +36,37 @@ def download_image(file_name, url):
         raise SystemError("Error downloading", url, ":", str(e))
 
 
-def upload_image(album_id, file_path):
-    """Uploads an image file to the specified Google Photos album."""
+def upload_bytes(file_path):
+    """Uploads the bytes of an image file and returns its upload token."""
     # Ref: https://stackoverflow.com/a/52021690
     # Ref: https://github.com/googleapis/google-api-python-client/issues/651#issuecomment-487398468
     # Ref: https://developers.google.com/photos/library/guides/upload-media?hl=en
-    try:
-        # Upload the image file to Google Photos
-        headers = {
-            "Content-Type": "application/octet-stream",
-            "X-Goog-Upload-File-Name": file_path.encode("utf-8"),
-            "X-Goog-Upload-Protocol": "raw",
-            "Authorization": "Bearer " + creds.token,
-        }
-        data = open(file_path, "rb").read()
-        response = requests.post(
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "X-Goog-Upload-File-Name": os.path.basename(file_path).encode("utf-8"),
+        "X-Goog-Upload-Protocol": "raw",
+    }
+    with open(file_path, "rb") as f:
+        response = upload_session.post(
             "https://photoslibrary.googleapis.com/v1/uploads",
             headers=headers,
-            data=data,
+            data=f,
         )
-        upload_token = response.text
+    if response.status_code != 200:
+        raise SystemError(f"Failed to upload '{file_path}': {response.text}")
+    return response.text
 
-        # Add the uploaded image to the album
+
+def batch_create(album_id, file_paths):
+    """Adds uploaded image files to an album, BATCH_SIZE items per request.
+
+    Returns the media item ID of each file, or None for a file which failed.
+    """
+    upload_tokens = [upload_bytes(file_path) for file_path in file_paths]
+    # the results are keyed by upload token, a missing one is a failure
+    media_item_ids = {}
+    statuses = {}
+    for start in range(0, len(file_paths), BATCH_SIZE):
         request_body = {
             "albumId": album_id,
             "newMediaItems": [
@@ -57,69 +76,236 @@ def upload_image(album_id, file_path):
                         "uploadToken": upload_token,
                     }
                 }
+                for file_path, upload_token in zip(
+                    file_paths[start : start + BATCH_SIZE],
+                    upload_tokens[start : start + BATCH_SIZE],
+                )
             ],
         }
         response = photos_service.mediaItems().batchCreate(body=request_body).execute()
-        items = response.get("newMediaItemResults", [])
-        image_id = items[0]["mediaItem"]["id"]
-        media_item = photos_service.mediaItems().get(mediaItemId=image_id).execute()
-        # Get the URL of the uploaded image
-        if len(items) == 1:
-            print(media_item)
-            # ERROR: the link expire after approximately 60 minutes.
-            # https://developers.google.com/photos/library/guides/best-practices?hl=en#caching
-            image_url = media_item["baseUrl"] + "=w2048-h1024"
-            print(f"Image '{file_path}' uploaded to album and URL is: {image_url}")
-            return image_url
-        else:
-            raise SystemError(
-                f"An error occurred while uploading image '{file_path}' to album"
-            )
-
-    except HttpError as error:
-        raise SystemError(
-            f"An error occurred while uploading image '{file_path}' to album: {error}"
+        for result in response.get("newMediaItemResults", []):
+            if "mediaItem" in result:
+                media_item_ids[result["uploadToken"]] = result["mediaItem"]["id"]
+            else:
+                statuses[result.get("uploadToken")] = result.get("status")
+
+    for file_path, upload_token in zip(file_paths, upload_tokens):
+        if media_item_ids.get(upload_token) is None:
+            status = statuses.get(upload_token, "no result")
+            print(f"Image '{file_path}' not added to album: {status}")
+    return [media_item_ids.get(upload_token) for upload_token in upload_tokens]
+
+
+def batch_get(media_item_ids):
+    """Returns the media items of the IDs which still exist, keyed by ID, with
+    one mediaItems.batchGet request per BATCH_SIZE IDs."""
+    media_items = {}
+    media_item_ids = list(media_item_ids)
+    for start in range(0, len(media_item_ids), BATCH_SIZE):
+        response = (
+            photos_service.mediaItems()
+            .batchGet(mediaItemIds=media_item_ids[start : start + BATCH_SIZE])
+            .execute()
         )
+        for result in response.get("mediaItemResults", []):
+            if "mediaItem" in result:
+                media_items[result["mediaItem"]["id"]] = result["mediaItem"]
+    return media_items
+
+
+def get_album_index():
+    """Lists the albums created by this app once, page by page, and returns
+    their IDs keyed by title; the API can only add items to those albums."""
+    album_index = {}
+    page_token = None
+    while True:
+        results = (
+            photos_service.albums()
+            .list(pageSize=50, pageToken=page_token, excludeNonAppCreatedData=True)
+            .execute()
+        )
+        for album in results.get("albums", []):
+            if "title" in album.keys():
+                album_index.setdefault(album["title"], album["id"])
+        page_token = results.get("nextPageToken")
+        if page_token is None:
+            return album_index
 
 
-def create_album_if_not_exists(album_name):
+def create_album_if_not_exists(album_name, album_index):
     """Creates a new album in Google Photos with the given name if it doesn't already exist."""
-    results = photos_service.albums().list().execute()
-    albums = results.get("albums", [])
-    from pprint import pprint
-
-    # pprint(albums)
-    for album in albums:
-        if "title" in album.keys():
-            print(album["title"])
-        if "title" in album.keys() and album["title"] == album_name:
-            print(f"Album '{album_name}' already exists with ID {album['id']}.")
-            return album["id"]
+    if album_name in album_index:
+        print(f"Album '{album_name}' already exists with ID {album_index[album_name]}.")
+        return album_index[album_name]
     print(f"Creating album '{album_name}'...")
     new_album = (
         photos_service.albums().create(body={"album": {"title": album_name}}).execute()
     )
     album_id = new_album["id"]
+    album_index[album_name] = album_id
     print(f"Album '{album_name}' created with ID {album_id}.")
     return album_id
 
 
-def upload_to_album(album_title, file_names):
-    """Uploads all images from a markdown file to a shared album on Google Photos."""
+def upload_to_album(album_title, file_names, album_index, redirect_base):
+    """Uploads all images from a markdown file to a shared album on Google Photos.
+
+    Returns their stable URLs under `redirect_base`, served by the redirect
+    service (see serve()); an image which failed gets None.
+    """
     try:
         # Create the album with the same name as the markdown file, if it doesn't exist
-        album_id = create_album_if_not_exists(album_title)
+        album_id = create_album_if_not_exists(album_title, album_index)
         print(f"send images to album '{album_title}' ({album_id})")
 
         # Upload images to album and get new URLs
+        media_item_ids = batch_create(album_id, file_names)
         new_urls = []
-        for file_name in file_names:
-            new_url = upload_image(album_id, file_name)
-            if new_url:
-                new_urls.append(new_url)
+        for file_name, media_item_id in zip(file_names, media_item_ids):
+            new_url = None
+            if media_item_id is not None:
+                new_url = f"{redirect_base}/{media_item_id}"
+                print(f"Image '{file_name}' uploaded to album and URL is: {new_url}")
+            new_urls.append(new_url)
         return new_urls
-    except Exception as e:
-        raise SystemError("Error uploading to album:", str(e))
+    except HttpError as error:
+        raise SystemError(f"Error uploading to album: {error}")
+
+
+class BaseUrlCache:
+    """Keeps the baseUrl of media items fresh for the redirect service.
+
+    A baseUrl is used for BASE_URL_TTL seconds after it was fetched. The
+    missing or expired ones wanted by requests are fetched together by one
+    thread, BATCH_SIZE per mediaItems.batchGet call: requests arriving within
+    `batch_window` seconds share a call, and the call is filled up with the
+    known items which expire soonest, so that busy items are refreshed before
+    anyone waits for them. The baseUrls survive restarts in a SQLite file.
+    """
+
+    def __init__(self, cache_file, batch_window=0.05, timeout=30.0):
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self.db = sqlite3.connect(cache_file, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS base_urls ("
+            " media_item_id TEXT PRIMARY KEY, base_url TEXT, fetched_at REAL)"
+        )
+        self.base_urls = {
+            media_item_id: (base_url, fetched_at)
+            for media_item_id, base_url, fetched_at in self.db.execute(
+                "SELECT media_item_id, base_url, fetched_at FROM base_urls"
+            )
+        }
+        self.wanted = set()
+        self.failed = set()
+        self.condition = threading.Condition()
+        threading.Thread(target=self._refresh_forever, daemon=True).start()
+
+    def _fresh(self, media_item_id, margin=0.0):
+        entry = self.base_urls.get(media_item_id)
+        if entry is None:
+            return False
+        return time.time() - entry[1] < BASE_URL_TTL - margin
+
+    def get(self, media_item_id):
+        """Returns the current baseUrl of a media item, or None if it does
+        not exist (anymore); raises SystemError if it cannot be fetched."""
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            self.failed.discard(media_item_id)
+            while not self._fresh(media_item_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or media_item_id in self.failed:
+                    raise SystemError(f"Failed to get media item {media_item_id}")
+                self.wanted.add(media_item_id)
+                self.condition.notify_all()
+                self.condition.wait(remaining)
+            return self.base_urls[media_item_id][0]
+
+    def _refresh_forever(self):
+        while True:
+            with self.condition:
+                while not self.wanted:
+                    self.condition.wait()
+            time.sleep(self.batch_window)  # let concurrent requests join
+            with self.condition:
+                batch = list(self.wanted)[:BATCH_SIZE]
+                # fill the call up with the items which expire next
+                expiring = sorted(
+                    (
+                        media_item_id
+                        for media_item_id in self.base_urls
+                        if media_item_id not in self.wanted
+                        and self.base_urls[media_item_id][0] is not None
+                        and not self._fresh(media_item_id, margin=10 * 60)
+                    ),
+                    key=lambda media_item_id: self.base_urls[media_item_id][1],
+                )
+                batch += expiring[: BATCH_SIZE - len(batch)]
+            try:
+                media_items = batch_get(batch)
+            except Exception as error:
+                # e.g. an HttpError, a token which cannot be refreshed, or a
+                # timeout: the requests of the batch get a 502, and the thread
+                # keeps serving the next ones
+                print(f"An error occurred: {error!r}")
+                with self.condition:
+                    self.wanted.difference_update(batch)
+                    self.failed.update(batch)
+                    self.condition.notify_all()
+                time.sleep(1)
+                continue
+            now = time.time()
+            with self.condition:
+                for media_item_id in batch:
+                    self.wanted.discard(media_item_id)
+                    self.failed.discard(media_item_id)
+                    # None for an item which was deleted, or not created by
+                    # this app: answer 404 until the entry expires
+                    base_url = media_items.get(media_item_id, {}).get("baseUrl")
+                    self.base_urls[media_item_id] = (base_url, now)
+                self.condition.notify_all()
+            try:
+                with self.db:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO base_urls VALUES (?, ?, ?)",
+                        [
+                            (media_item_id, media_item["baseUrl"], now)
+                            for media_item_id, media_item in media_items.items()
+                        ],
+                    )
+            except sqlite3.Error as error:
+                print(f"Failed to save the baseUrls: {error}")
+
+
+def serve(host, port, path_prefix, cache):
+    """Serves stable links to Google Photos images: GET {path_prefix}/{id}
+    redirects to the current baseUrl of the media item."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = re.fullmatch(re.escape(path_prefix) + r"/([\w-]+)", self.path)
+            try:
+                base_url = cache.get(match[1]) if match is not None else None
+            except SystemError as error:
+                self.send_error(502, str(error))
+                return
+            if base_url is None:
+                self.send_error(404)
+                return
+            self.send_response(302)
+            self.send_header("Location", base_url + IMAGE_SIZE)
+            # the target expires, so the redirect must not be kept for long
+            self.send_header("Cache-Control", "private, max-age=600")
+            self.end_headers()
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serve Google Photos images on http://{host}:{port}{path_prefix}/<id>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
 
 
 # Replace old URLs with new URLs in Markdown file
@@ -128,7 +314,8 @@ def replace_urls_in_md(old_urls, new_urls, md_file):
         md_content = f.read()
 
     for old_url, new_url in zip(old_urls, new_urls):
-        md_content = md_content.replace(old_url, new_url)
+        if new_url is not None:
+            md_content = md_content.replace(old_url, new_url)
 
     with open(md_file, "w") as f:
         f.write(md_content)
@@ -198,10 +385,12 @@ def setup(credentials_json):
             token.write(creds.to_json())
     # Build the service object
     try:
-        global photos_service
+        global photos_service, upload_session
         photos_service = build(
             "photoslibrary", "v1", credentials=creds, static_discovery=False
         )
+        # refreshes the token by itself, unlike a bare Authorization header
+        upload_session = AuthorizedSession(creds)
         print("Google Photos API service created.")
 
     except HttpError as error:
@@ -212,12 +401,36 @@ def setup(credentials_json):
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("md_file", help="path to Markdown file")
-    parser.add_argument("cred", help="path to Markdown file")
+    parser.add_argument("md_file", nargs="?", help="path to Markdown file")
+    parser.add_argument("cred", help="path to the OAuth client secrets file")
+    parser.add_argument(
+        "--redirect-base",
+        default="http://localhost:8080/photos",
+        help="base of the stable image links written in the Markdown file",
+    )
+    parser.add_argument(
+        "--serve",
+        help="run the redirect service behind --redirect-base",
+        action="store_true",
+    )
+    parser.add_argument("--host", default="localhost", help="address to serve on")
+    parser.add_argument("--port", type=int, default=8080, help="port to serve on")
+    parser.add_argument(
+        "--cache",
+        default="photos_base_urls.sqlite3",
+        help="file keeping the baseUrls between restarts of the service",
+    )
     args = parser.parse_args()
+    if args.md_file is None and not args.serve:
+        parser.error("the following arguments are required: md_file")
 
     setup(args.cred)
 
+    if args.serve:
+        path_prefix = requests.utils.urlparse(args.redirect_base).path.rstrip("/")
+        serve(args.host, args.port, path_prefix, BaseUrlCache(args.cache))
+        return
+
     # Get image URLs from Markdown file
     image_data_list = get_image_data_list_from_md(args.md_file)
     print(image_data_list)
@@ -234,7 +447,9 @@ def main():
     album_title = (
         "aben20807.github.io:" + os.path.splitext(os.path.basename(args.md_file))[0]
     )
-    new_urls = upload_to_album(album_title, file_names)
+    new_urls = upload_to_album(
+        album_title, file_names, get_album_index(), args.redirect_base.rstrip("/")
+    )
 
     # Replace old URLs with new URLs in Markdown file
     img_urls = [image_data["old_url"] for image_data in image_data_list]
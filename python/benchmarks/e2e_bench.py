@@ -0,0 +1,235 @@
+"""
+End-to-end benchmark of the transfer, offline.
+
+It serves synthetic images from a local fake image host, plugs a fake Drive v3
+backend into build_drive_service(), points the new URLs at the fake host too,
+generates markdown corpora of the given sizes, runs the whole transfer
+(img_host_transfer.main) on each of them in a scratch directory, and reports
+per stage the images/sec, the Drive API calls per image and the peak RSS (of
+the benchmark process, fake image host included). Options after "--" are passed to the transfer.
+
+    $ python python/benchmarks/e2e_bench.py --notes 10 100
+    $ python python/benchmarks/e2e_bench.py --latency 0.05 --error-rate 0.02 \\
+        --drive-qps-limit 20 -- --upload-workers 4
+"""
+
+import argparse
+import contextlib
+import functools
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import img_host_transfer  # noqa: E402
+from fakes import FakeDrive, FakeDriveHttp, FakeImageHost  # noqa: E402
+
+STAGES = [
+    "probe_stage",
+    "download_stage",
+    "optimize_stage",
+    "upload_stage",
+    "verify_stage",
+    "rewrite_stage",
+]
+# the stage which issues each kind of Drive call; the others come from the
+# folder setup before the pipeline starts
+STAGE_OF_CALL = {
+    "get": "download_stage",
+    "list_files": "upload_stage",
+    "upload": "upload_stage",
+    "upload_start": "upload_stage",
+    "upload_chunk": "upload_stage",
+    "copy": "upload_stage",
+    "delete": "upload_stage",
+}
+
+
+def current_rss():
+    """Returns the resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # not Linux, fall back to the peak so far
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_corpus(directory, host, notes, images_per_note, shared, image_size, seed):
+    """Writes `notes` markdown files; returns the number of image links.
+
+    A `shared` share of the images is picked from a small pool used by all the
+    notes, like logos and banners, and the others are unique.
+    """
+    rng = random.Random(seed)
+    pool = [rng.getrandbits(32) for _ in range(max(images_per_note, 1))]
+    links = 0
+    for idx in range(notes):
+        lines = ["+++", f'title = "note {idx}"', "+++"]
+        for cnt in range(images_per_note):
+            image_seed = (
+                rng.choice(pool) if rng.random() < shared else rng.getrandbits(32)
+            )
+            size = max(int(rng.expovariate(1 / image_size)), 64)
+            lines.append(f"![figure {cnt}]({host.url(image_seed, size)})")
+            lines.append("lorem ipsum " * rng.randint(5, 50))
+            links += 1
+        with open(os.path.join(directory, f"note_{idx}.md"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    return links
+
+
+def instrument(module, metrics):
+    """Wraps the pipeline stages of the module to record their metrics."""
+    originals = {}
+    for name in STAGES:
+        stage = getattr(module, name)
+        originals[name] = stage
+        metrics[name] = {"busy": 0.0, "images": 0, "rss": 0}
+
+        def wrapper(job, ctx, stage=stage, stats=metrics[name]):
+            images = len(job["image_data_list"]) + len(job.get("copy_list", []))
+            start = time.perf_counter()
+            try:
+                return stage(job, ctx)
+            finally:
+                stats["busy"] += time.perf_counter() - start
+                stats["images"] += images
+                stats["rss"] = max(stats["rss"], current_rss())
+
+        setattr(module, name, functools.wraps(stage)(wrapper))
+    return originals
+
+
+def run(args, notes, transfer_args):
+    drive = FakeDrive(args.drive_qps_limit, args.quota_error_rate, args.seed)
+    host = FakeImageHost(args.latency, args.error_rate, args.seed, drive)
+    module = img_host_transfer
+    build_drive_service = module.build_drive_service
+    new_url_base = module.NEW_URL_BASE
+    # the new URLs point at the fake host, so that --probe can verify them
+    module.NEW_URL_BASE = host.drive_url_base()
+    module.build_drive_service = lambda credentials_file: module.build_from_document(
+        module.load_discovery_document(),
+        http=FakeDriveHttp(drive),
+        requestBuilder=module.MeteredHttpRequest,
+    )
+    # drop the services of a former run
+    module._thread_local = threading.local()
+    module._idle_drive_services.clear()
+    metrics = {}
+    originals = instrument(module, metrics)
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            os.makedirs("notes")
+            links = make_corpus(
+                "notes",
+                host,
+                notes,
+                args.images_per_note,
+                args.shared,
+                args.image_size,
+                args.seed,
+            )
+            os.environ["root_id"] = drive.root_id
+            sys.argv = ["img_host_transfer", "fake-credentials.json", "-r", "notes"]
+            sys.argv += transfer_args
+            start = time.perf_counter()
+            with open(args.log, "a") as log, contextlib.redirect_stdout(log):
+                module.main()
+            elapsed = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        module.build_drive_service = build_drive_service
+        module.NEW_URL_BASE = new_url_base
+        for name, stage in originals.items():
+            setattr(module, name, stage)
+        host.close()
+    return links, elapsed, metrics, drive, host
+
+
+def report(notes, links, elapsed, metrics, drive, host):
+    print(
+        f"\n{notes} notes, {links} image links: {elapsed:.2f}s,"
+        f" {links / elapsed:.1f} images/s,"
+        f" {drive.total_calls() / max(links, 1):.2f} Drive calls/image,"
+        f" {drive.calls.get('rate_limited', 0)} rate limited,"
+        f" {host.requests} image requests ({host.errors} failed)"
+    )
+    calls = {name: 0 for name in ["setup"] + STAGES}
+    for operation, count in drive.calls.items():
+        if operation != "rate_limited":
+            calls[STAGE_OF_CALL.get(operation, "setup")] += count
+    print(
+        f"{'stage':>15} {'images':>7} {'busy s':>8} {'images/s':>9}"
+        f" {'calls/image':>11} {'peak RSS':>9}"
+    )
+    print(
+        f"{'setup':>15} {'':>7} {'':>8} {'':>9}"
+        f" {calls['setup'] / max(links, 1):11.2f} {'':>9}"
+    )
+    for name in STAGES:
+        stats = metrics[name]
+        if stats["images"] == 0 and stats["busy"] == 0:
+            continue
+        print(
+            f"{name:>15} {stats['images']:7d} {stats['busy']:8.2f}"
+            f" {stats['images'] / max(stats['busy'], 1e-9):9.1f}"
+            f" {calls[name] / max(stats['images'], 1):11.2f}"
+            f" {stats['rss'] / 2**20:7.1f}Mi"
+        )
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print(f"process peak RSS {peak:.1f}Mi")
+
+
+def main():
+    argv = sys.argv[1:]
+    transfer_args = []
+    if "--" in argv:
+        transfer_args = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    parser = argparse.ArgumentParser(description="Benchmark the whole transfer.")
+    parser.add_argument(
+        "--notes", type=int, nargs="+", default=[10, 100], help="Corpus sizes."
+    )
+    parser.add_argument(
+        "--images-per-note", type=int, default=8, help="Image links per note."
+    )
+    parser.add_argument(
+        "--shared", type=float, default=0.2, help="Share of images used by many notes."
+    )
+    parser.add_argument(
+        "--image-size", type=int, default=50000, help="Mean image size in bytes."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="Image host latency in seconds."
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of image requests failing."
+    )
+    parser.add_argument(
+        "--drive-qps-limit", type=int, help="Drive calls per second before 403s."
+    )
+    parser.add_argument(
+        "--quota-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of Drive calls answered with a quota error anyway.",
+    )
+    parser.add_argument(
+        "--log", type=str, default=os.devnull, help="Append the transfer output here."
+    )
+    parser.add_argument("--seed", type=int, default=20230101, help="Random seed.")
+    args = parser.parse_args(argv)
+
+    for notes in args.notes:
+        report(notes, *run(args, notes, transfer_args))
+
+
+if __name__ == "__main__":
+    main()
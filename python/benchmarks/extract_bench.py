@@ -0,0 +1,170 @@
+"""
+Micro-benchmark for the markdown image extractor.
+
+It generates a deterministic corpus of notes which look like our Hugo posts
+and HackMD exports (front matter banners, inline images, Google Drive links,
+bare Imgur URLs, and a few very long lines), checks that the single-pass
+extractor finds the same images as the former multi-scan one, and reports the
+throughput of both.
+
+    $ python python/benchmarks/extract_bench.py --notes 20000
+    $ python python/benchmarks/extract_bench.py --notes 1000 --out corpus/
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from img_host_transfer import extract_image_data_list  # noqa: E402
+
+
+def make_note(rng, idx):
+    """Generates one markdown note."""
+    lines = ["+++", f'title = "note {idx}"']
+    if rng.random() < 0.5:
+        lines.append(f'image = "https://example.com/banner/{idx}.jpg"')
+    elif rng.random() < 0.5:
+        lines.append(f'image = "https://images.unsplash.com/photo-{idx}"')
+    lines.append("+++")
+    for paragraph in range(rng.randint(5, 40)):
+        kind = rng.random()
+        if kind < 0.3:
+            lines.append(
+                f"![figure {paragraph}](https://i.imgur.com/{rng.getrandbits(32):x}.png)"
+            )
+        elif kind < 0.4:
+            lines.append(
+                f"![](https://example.com/img/{idx}/{paragraph}.gif"
+                f' "title {paragraph}")'
+            )
+        elif kind < 0.45:
+            lines.append(
+                f"![drive](https://drive.google.com/open?id={rng.getrandbits(64):x})"
+            )
+        elif kind < 0.5:
+            lines.append(f"see https://imgur.com/{rng.getrandbits(32):x} for details")
+        elif kind < 0.52:
+            # a long table row or a minified snippet pasted in a note
+            lines.append("| " + "![cell] " * 500 + "x" * 20000 + " |")
+        else:
+            lines.append(
+                " ".join(
+                    rng.choice(["lorem", "ipsum", "[link](a)", "`code`"])
+                    for _ in range(60)
+                )
+            )
+    return "\n".join(lines) + "\n"
+
+
+def legacy_extract(md_content, md_file, hackmd=False):
+    """The former extractor, one re.findall per kind of image."""
+    md_name = os.path.splitext(os.path.basename(md_file))[0]
+
+    def caption(image_caption, cnt):
+        if image_caption.strip() != "":
+            return (
+                "".join([x if x.isalnum() else "_" for x in image_caption])[:100]
+                + f"_{cnt}"
+            )
+        return md_name + f"_{cnt}"
+
+    image_data_list = []
+    if hackmd:
+        matches = re.findall(r"(https?://(i.)?imgur.com/[^\ \n)\"]*)", md_content)
+        for cnt, match in enumerate(matches):
+            image_data_list.append(
+                {"caption": caption("", cnt), "url": match[0], "old_url": match[0]}
+            )
+        return image_data_list
+
+    cnt = 0
+    pattern = r"!\[(.*)\]\(((?!https://drive.google.com).*?)( \".*\")?\)"
+    for match in re.findall(pattern, md_content):
+        image_caption = caption(match[0], cnt)
+        cnt += 1
+        if not match[1].startswith("http"):
+            continue
+        image_data_list.append(
+            {"caption": image_caption, "url": match[1], "old_url": match[1]}
+        )
+    pattern = r"!\[(.*)\]\((https://drive.google.com/open.+id=([^\"]+?))( \".*\")?\)"
+    for match in re.findall(pattern, md_content):
+        image_data_list.append(
+            {
+                "caption": caption(match[0], cnt),
+                "url": "https://lh3.googleusercontent.com/d/" + match[2],
+                "old_url": match[1],
+            }
+        )
+        cnt += 1
+    pattern = r"image = \"((?!https://images.unsplash.com).+)\""
+    for match in re.findall(pattern, md_content):
+        image_data_list.append(
+            {"caption": f"{md_name}_banner", "url": match, "old_url": match}
+        )
+    return image_data_list
+
+
+def bench(extract, corpus, hackmd):
+    start = time.perf_counter()
+    images = 0
+    for md_file, md_content in corpus:
+        images += len(extract(md_content, md_file, hackmd))
+    return time.perf_counter() - start, images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image extractor.")
+    parser.add_argument("--notes", type=int, default=500, help="Number of notes.")
+    parser.add_argument("--seed", type=int, default=20230101, help="Corpus seed.")
+    parser.add_argument(
+        "--out", type=str, help="Also write the corpus as markdown files here."
+    )
+    parser.add_argument(
+        "--skip-legacy",
+        help="Do not run the former extractor (slow on long lines)",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [(f"note_{idx}.md", make_note(rng, idx)) for idx in range(args.notes)]
+    size = sum(len(md_content) for _, md_content in corpus)
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+        for md_file, md_content in corpus:
+            with open(os.path.join(args.out, md_file), "w") as f:
+                f.write(md_content)
+    print(f"Corpus: {len(corpus)} notes, {size / 2**20:.1f} MiB")
+
+    # well-formed notes must give the same images with both extractors
+    for md_file, md_content in corpus:
+        if "![cell]" in md_content:
+            continue
+        for hackmd in (False, True):
+            images = [
+                {key: image[key] for key in ("caption", "url", "old_url")}
+                for image in extract_image_data_list(md_content, md_file, hackmd)
+            ]
+            if images != legacy_extract(md_content, md_file, hackmd):
+                sys.exit(f"Extractors disagree on {md_file} (hackmd={hackmd})")
+
+    extractors = [("single-pass", extract_image_data_list)]
+    if not args.skip_legacy:
+        extractors.append(("legacy", legacy_extract))
+    for name, extract in extractors:
+        for hackmd in (False, True):
+            elapsed, images = bench(extract, corpus, hackmd)
+            print(
+                f"{name:>11} hackmd={hackmd!s:<5} {elapsed:8.3f}s"
+                f" {len(corpus) / elapsed:10.0f} notes/s"
+                f" {size / 2**20 / elapsed:8.1f} MiB/s {images} images"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Local stand-ins for the services the transfer talks to, for benchmarks.
+
++ FakeImageHost: an HTTP server on 127.0.0.1 serving deterministic synthetic
+  images at /img/<seed>/<size>.png, with a configurable latency and rate of
+  500 errors, and ETag revalidation; given a FakeDrive, it also stands in for
+  lh3.googleusercontent.com and serves its files at /d/<file id>
++ FakeDrive: an in-memory Drive v3 backend (files list/get/create/copy/delete,
+  multipart and resumable uploads, batch requests) which answers with quota
+  errors past a number of calls per second or at random, and counts calls
++ FakeDriveHttp: the httplib2-like transport which hands the requests of a
+  googleapiclient service to a FakeDrive, so the real client code still runs
+"""
+
+import email.parser
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import httplib2
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+def synthetic_image(seed, size):
+    """Returns `size` deterministic bytes which start like a PNG file."""
+    rng = random.Random(seed)
+    return (PNG_HEADER + rng.randbytes(max(size - len(PNG_HEADER), 0)))[:size]
+
+
+class FakeImageHost:
+    """Serves synthetic images from a thread until close() is called.
+
+    The files of `drive` are served at /d/<file id> with their size, but
+    with synthetic bytes, as FakeDrive only keeps their checksum.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, drive=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                image = None
+                match = re.fullmatch(r"/img/(\d+)/(\d+)\.png", self.path)
+                if match is not None:
+                    image = tuple(map(int, match.groups()))
+                match = re.fullmatch(r"/d/([\w-]+)", self.path)
+                if match is not None and drive is not None:
+                    with drive.lock:
+                        file = drive.files.get(match[1])
+                    if file is not None and "size" in file:
+                        image = match[1], int(file["size"])
+                with host.lock:
+                    host.requests += 1
+                    fail = host.rng.random() < host.error_rate
+                    host.errors += fail
+                if host.latency:
+                    time.sleep(host.latency)
+                if image is None or fail:
+                    self.send_error(404 if image is None else 500)
+                    return
+                seed, size = image
+                etag = f'"{seed}-{size}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = synthetic_image(seed, size)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, seed, size):
+        return f"http://127.0.0.1:{self.server.server_port}/img/{seed}/{size}.png"
+
+    def drive_url_base(self):
+        """The base of the URLs of the FakeDrive files, like NEW_URL_BASE."""
+        return f"http://127.0.0.1:{self.server.server_port}/d/"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeDrive:
+    """An in-memory Drive v3 backend.
+
+    Calls over `qps_limit` in the current second, and a `quota_error_rate`
+    share of the others, are answered with 403 userRateLimitExceeded like the
+    real service under load. `calls` counts the calls by operation, and
+    "rate_limited" counts the rejected ones.
+    """
+
+    def __init__(self, qps_limit=None, quota_error_rate=0.0, seed=0):
+        self.qps_limit = qps_limit
+        self.quota_error_rate = quota_error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.sessions = {}
+        self.calls = {}
+        self.ids = itertools.count()
+        self.second = 0
+        self.second_calls = 0
+        self.root_id = self._add({"name": "root", "mimeType": FOLDER_MIME_TYPE})
+
+    def _add(self, file):
+        file = dict(file)
+        file["id"] = f"fake{next(self.ids):08d}"
+        file.setdefault("parents", [])
+        file.setdefault("mimeType", "application/octet-stream")
+        self.files[file["id"]] = file
+        return file["id"]
+
+    def _count(self, operation):
+        """Counts a call; returns False if it hits the simulated quota."""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            second = int(time.monotonic())
+            if second != self.second:
+                self.second, self.second_calls = second, 0
+            self.second_calls += 1
+            limited = (
+                self.qps_limit is not None and self.second_calls > self.qps_limit
+            ) or self.rng.random() < self.quota_error_rate
+            if limited:
+                self.calls["rate_limited"] = self.calls.get("rate_limited", 0) + 1
+            return not limited
+
+    def total_calls(self):
+        return sum(
+            count
+            for operation, count in self.calls.items()
+            if operation != "rate_limited"
+        )
+
+    def handle(self, method, uri, body, headers):
+        """Answers one request with (status, headers, body bytes)."""
+        parts = urlsplit(uri)
+        path = parts.path
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        if hasattr(body, "read"):  # chunks of a file upload
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        body = body or b""
+
+        if path.startswith("/batch/"):
+            return self._batch(body, headers)
+        if path.startswith("/upload/sessions/"):
+            return self._upload_chunk(path.rsplit("/", 1)[1], body, headers)
+        if path == "/upload/drive/v3/files" and method == "POST":
+            if query.get("uploadType") == "resumable":
+                operation = "upload_start"
+            else:
+                operation = "upload"
+        elif path == "/drive/v3/files" and method == "GET":
+            folders = f"mimeType = '{FOLDER_MIME_TYPE}'" in query.get("q", "")
+            operation = "list_folders" if folders else "list_files"
+        elif path == "/drive/v3/files" and method == "POST":
+            operation = "create"
+        elif path.endswith("/copy"):
+            operation = "copy"
+        elif method == "DELETE":
+            operation = "delete"
+        else:
+            operation = "get"
+        if not self._count(operation):
+            return self._error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+
+        if operation == "upload":
+            metadata, media = self._split_multipart(body, headers["content-type"])
+            return self._json(200, self._create(metadata, media))
+        if operation == "upload_start":
+            session_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions[session_id] = {
+                    "metadata": json.loads(body or b"{}"),
+                    "data": bytearray(),
+                }
+            location = f"https://www.googleapis.com/upload/sessions/{session_id}"
+            return 200, {"location": location}, b""
+        if operation in ("list_folders", "list_files"):
+            return self._list(query)
+        if operation == "create":
+            return self._json(200, self._create(json.loads(body), None))
+        file_id = path.split("/")[4]
+        with self.lock:
+            file = self.files.get(file_id)
+        if file is None:
+            return self._error(404, "notFound", f"File not found: {file_id}.")
+        if operation == "copy":
+            metadata = dict(file)
+            metadata.update(json.loads(body or b"{}"))
+            metadata.pop("id")
+            with self.lock:
+                return self._json(200, {"id": self._add(metadata)})
+        if operation == "delete":
+            with self.lock:
+                del self.files[file_id]
+            return 204, {}, b""
+        return self._json(200, file)
+
+    def _create(self, metadata, media):
+        file = dict(metadata)
+        if media is not None:
+            file["sha256Checksum"] = hashlib.sha256(media).hexdigest()
+            file["size"] = str(len(media))
+        with self.lock:
+            return {"id": self._add(file)}
+
+    def _list(self, query):
+        q = query.get("q", "")
+        parent = re.search(r"'([^']*)' in parents", q)
+        folders = f"mimeType = '{FOLDER_MIME_TYPE}'" in q
+        with self.lock:
+            files = sorted(
+                (
+                    file
+                    for file in self.files.values()
+                    if (parent is None or parent.group(1) in file["parents"])
+                    and (file["mimeType"] == FOLDER_MIME_TYPE) == folders
+                ),
+                key=lambda file: file["id"],
+            )
+        page_size = int(query.get("pageSize", 100))
+        start = int(query.get("pageToken", 0))
+        result = {"files": files[start : start + page_size]}
+        if start + page_size < len(files):
+            result["nextPageToken"] = str(start + page_size)
+        return self._json(200, result)
+
+    def _upload_chunk(self, session_id, body, headers):
+        if not self._count("upload_chunk"):
+            return self._error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            return self._error(404, "notFound", "Upload session expired.")
+        # e.g. "bytes 0-262143/1000000", "bytes 0-262143/*", or "bytes */1000000"
+        span, total = headers["content-range"].split(" ", 1)[1].split("/")
+        if span != "*":
+            start = int(span.split("-")[0])
+            del session["data"][start:]
+            session["data"] += body
+        if total != "*" and len(session["data"]) >= int(total):
+            with self.lock:
+                del self.sessions[session_id]
+            return self._json(200, self._create(session["metadata"], session["data"]))
+        response_headers = {}
+        if session["data"]:
+            response_headers["range"] = f"bytes=0-{len(session['data']) - 1}"
+        return 308, response_headers, b""
+
+    def _batch(self, body, headers):
+        if not self._count("batch"):
+            return self._error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + headers["content-type"].encode() + b"\r\n\r\n" + body
+        )
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, request = request.split("\n", 1)
+            method, uri, _ = request_line.split(" ")
+            request_headers, _, request_body = request.partition("\n\n")
+            request_headers = dict(
+                line.split(": ", 1) for line in request_headers.splitlines() if line
+            )
+            status, _, content = self.handle(method, uri, request_body, request_headers)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                + content.decode("utf-8")
+                + "\r\n"
+            )
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        return (
+            200,
+            {"content-type": f"multipart/mixed; boundary={boundary}"},
+            content.encode("utf-8"),
+        )
+
+    @staticmethod
+    def _split_multipart(body, content_type):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        metadata, media = message.get_payload()
+        return json.loads(metadata.get_payload()), media.get_payload(decode=True)
+
+    @staticmethod
+    def _json(status, result):
+        return status, {"content-type": "application/json"}, json.dumps(result).encode()
+
+    @classmethod
+    def _error(cls, status, reason, message):
+        return cls._json(
+            status,
+            {
+                "error": {
+                    "code": status,
+                    "message": message,
+                    "errors": [{"domain": "usageLimits", "reason": reason}],
+                }
+            },
+        )
+
+
+class FakeDriveHttp:
+    """An httplib2.Http look-alike which sends the requests to a FakeDrive."""
+
+    def __init__(self, drive):
+        self.drive = drive
+        self.timeout = None
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        status, headers, content = self.drive.handle(method, uri, body, headers)
+        headers = dict(headers, status=str(status))
+        return httplib2.Response(headers), content
@@ -20,288 +20,3220 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-import glob
+
+import fnmatch
 import os
 import re
 import shutil
+import threading
+import sqlite3
+import time
 import requests
 import argparse
 import json
+import queue
+import functools
 import hashlib
+import random
+import tempfile
+import multiprocessing
+import mmap
+import logging
+import contextlib
+import signal
+import sys
+import weakref
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaUpload, HttpRequest
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # only needed by --optimize
+    Image = None
+
+logger = logging.getLogger("img_host_transfer")
+
+# upper bounds of the latency histograms, in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """Counters and latency histograms of a run, shared by all threads.
+
+    Series are named like Prometheus ones and labelled with keyword arguments,
+    e.g. count("bytes", 1024, stage="download") or
+    observe("stage_seconds", 0.2, stage="upload").
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * len(HISTOGRAM_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for idx, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][idx] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """Observes the duration of the block in stage_seconds{stage=...}."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                "stage_seconds", time.perf_counter() - start, stage=stage, **labels
+            )
+
+    def total(self, name, **labels):
+        """Sums a counter over the series matching the given labels."""
+        with self.lock:
+            return sum(
+                value
+                for (counter, series), value in self.counters.items()
+                if counter == name and set(labels.items()) <= set(series)
+            )
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": time.time() - self.started_at,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram["count"],
+                        "sum": histogram["sum"],
+                        "buckets": dict(zip(HISTOGRAM_BUCKETS, histogram["buckets"])),
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def to_prometheus(self, prefix="img_host_transfer_") -> str:
+        """Renders the metrics in the Prometheus text exposition format."""
+
+        def escape(value):
+            return (
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n")
+            )
+
+        def series(name, labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return prefix + name
+            text = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+            return f"{prefix}{name}{{{text}}}"
+
+        lines = []
+        summary = self.summary()
+        typed = set()
+        for counter in summary["counters"]:
+            name = counter["name"] + "_total"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(
+                f"{series(name, counter['labels'].items())} {counter['value']}"
+            )
+        for histogram in summary["histograms"]:
+            name = histogram["name"]
+            labels = histogram["labels"].items()
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(
+                    f"{series(name + '_bucket', labels, [('le', bound)])} {count}"
+                )
+            lines.append(
+                f"{series(name + '_bucket', labels, [('le', '+Inf')])}"
+                f" {histogram['count']}"
+            )
+            lines.append(f"{series(name + '_sum', labels)} {histogram['sum']}")
+            lines.append(f"{series(name + '_count', labels)} {histogram['count']}")
+        lines.append(f"{prefix}run_duration_seconds {summary['duration_seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class JSONLogFormatter(logging.Formatter):
+    """Formats each log record as a JSON object on one line."""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+# Each mode scans a markdown file once with a precompiled pattern which starts
+# with a literal and never backtracks past a line end:
+# + inline images: ![caption](url "title"), captions may nest one level of []
+#   and Google Drive links are told apart afterwards
+# + banners in the front matter: image = "url"
+# + every Imgur URL in HackMD mode
+MD_IMAGE_PATTERN = re.compile(
+    r"!\[(?P<caption>(?:[^\[\]\n]|\[[^\[\]\n]*\])*)\]"
+    r"\((?P<url>[^\s)]*)(?:[ \t]+\"[^\"\n]*\")?\)"
+    r"|image = \"(?P<banner>[^\"\n]+)\""
+)
+IMGUR_URL_PATTERN = re.compile(r"https?://(?:i\.)?imgur\.com/[^ \n)\"]*")
+DRIVE_OPEN_ID_PATTERN = re.compile(
+    r"^https://drive\.google\.com/open.*?[?&]id=([^&\"]+)"
+)
+# the same patterns for the bytes of large files scanned through mmap; their
+# \s only matches ASCII whitespace, see extract_md_file()
+MD_IMAGE_BYTES_PATTERN = re.compile(MD_IMAGE_PATTERN.pattern.encode())
+IMGUR_URL_BYTES_PATTERN = re.compile(IMGUR_URL_PATTERN.pattern.encode())
+MMAP_THRESHOLD = 2**20  # larger markdown files are read through mmap
+
+
+def make_caption(image_caption, md_name, cnt):
+    if image_caption.strip() != "":
+        return (
+            "".join([x if x.isalnum() else "_" for x in image_caption])[:100]
+            + f"_{cnt}"
+        )
+    return md_name + f"_{cnt}"
+
+
+def extract_image_data_list(md_content, md_file, hackmd=False):
+    """Extracts the images of a markdown content in a single pass.
+
+    By default, returns the inline images hosted on the web, then the Google
+    Drive images (to be downloaded from lh3.googleusercontent.com), then the
+    banners which are not hosted on Unsplash. With `hackmd`, returns every
+    Imgur URL instead. `md_content` may also be the bytes of a UTF-8 file,
+    e.g. an mmap.
+    """
+    md_name = os.path.splitext(os.path.basename(md_file))[0]
+    md_image_pattern = MD_IMAGE_PATTERN
+    imgur_url_pattern = IMGUR_URL_PATTERN
+
+    def group(match, name):
+        return match.group(name)
+
+    if not isinstance(md_content, str):
+        md_image_pattern = MD_IMAGE_BYTES_PATTERN
+        imgur_url_pattern = IMGUR_URL_BYTES_PATTERN
+
+        def group(match, name):
+            value = match.group(name)
+            return value.decode("utf-8") if value is not None else None
+
+    image_data_list = []
+    if hackmd:
+        for cnt, match in enumerate(imgur_url_pattern.finditer(md_content)):
+            image_url = group(match, 0)
+            image_data_list.append(
+                {
+                    "caption": make_caption("", md_name, cnt),
+                    "url": image_url,
+                    "old_url": image_url,
+                }
+            )
+        return image_data_list
+
+    inline_list = []
+    drive_list = []
+    banner_list = []
+    for match in md_image_pattern.finditer(md_content):
+        image_url = group(match, "url")
+        if image_url is None:
+            image_url = group(match, "banner")
+            # we do not need to download images hosted on unsplash
+            if not image_url.startswith("https://images.unsplash.com"):
+                banner_list.append(image_url)
+        elif image_url.startswith("https://drive.google.com"):
+            drive_id = DRIVE_OPEN_ID_PATTERN.match(image_url)
+            if drive_id is not None:
+                drive_list.append((group(match, "caption"), image_url, drive_id[1]))
+        else:
+            inline_list.append((group(match, "caption"), image_url))
+
+    cnt = 0  # for anonymous images and avoid images with same caption
+    for image_caption, image_url in inline_list:
+        image_caption = make_caption(image_caption, md_name, cnt)
+        cnt += 1
+        if not image_url.startswith("http"):
+            continue
+        image_data_list.append(
+            {"caption": image_caption, "url": image_url, "old_url": image_url}
+        )
+
+    # Special case for google drive images
+    for image_caption, image_old_url, drive_id in drive_list:
+        image_data_list.append(
+            {
+                "caption": make_caption(image_caption, md_name, cnt),
+                "url": "https://lh3.googleusercontent.com/d/" + drive_id,
+                "old_url": image_old_url,
+                "drive_id": drive_id,
+            }
+        )
+        cnt += 1
+
+    # Special case for title images
+    for image_url in banner_list:
+        image_data_list.append(
+            {"caption": f"{md_name}_banner", "url": image_url, "old_url": image_url}
+        )
+
+    return image_data_list
+
+
+def extract_md_file(md_file, hackmd=False):
+    """Extracts the images of a markdown file, scanning it through mmap when
+    it is large instead of reading and decoding it whole."""
+    if os.path.getsize(md_file) >= MMAP_THRESHOLD:
+        with open(md_file, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as md_content:
+            image_data_list = extract_image_data_list(md_content, md_file, hackmd)
+            has_cr = md_content.find(b"\r") != -1
+        # the text patterns end URLs at any Unicode whitespace and see \r\n
+        # as \n; the rare files where it matters are read as text
+        if not has_cr and not any(
+            char.isspace()
+            for image_data in image_data_list
+            for char in image_data["url"]
+        ):
+            return image_data_list
+    with open(md_file, "r") as f:
+        md_content = f.read()
+    return extract_image_data_list(md_content, md_file, hackmd)
+
+
+def get_image_data_list_from_md(md_file):
+    """Extracts image URLs and their captions from a Markdown file."""
+    image_data_list = extract_md_file(md_file)
+    for image_data in image_data_list:
+        logger.debug("%s", image_data)
+    return image_data_list
+
+
+def get_imgur_data_list_from_md(md_file):
+    """ used for HackMD """
+    image_data_list = extract_md_file(md_file, hackmd=True)
+    for image_data in image_data_list:
+        logger.debug("%s", image_data)
+    return image_data_list
+
+
+def extract_records(md_file, hackmd=False):
+    """Runs in a worker process: returns the images of a markdown file as
+    compact (caption, url, old_url, drive_id) tuples, cheaper to send back to
+    the parent than dicts."""
+    return [
+        (
+            image_data["caption"],
+            image_data["url"],
+            image_data["old_url"],
+            image_data.get("drive_id"),
+        )
+        for image_data in extract_md_file(md_file, hackmd)
+    ]
+
+
+def image_data_from_record(record):
+    caption, url, old_url, drive_id = record
+    image_data = {"caption": caption, "url": url, "old_url": old_url}
+    if drive_id is not None:
+        image_data["drive_id"] = drive_id
+    return image_data
+
+
+MD_POOL_MIN_FILES = 500  # fewer markdown files are not worth the processes
+
+
+def extract_all_md_files(md_files, hackmd=False, pool=None, workers=1):
+    """Extracts the images of many markdown files, in the order of the files.
+
+    With a process `pool` of `workers` processes, the files are sent in
+    chunks so that each round trip carries enough work to pay for itself.
+    """
+    if pool is None or len(md_files) < MD_POOL_MIN_FILES:
+        if hackmd:
+            return [get_imgur_data_list_from_md(md_file) for md_file in md_files]
+        return [get_image_data_list_from_md(md_file) for md_file in md_files]
+    chunksize = max(1, min(256, len(md_files) // (workers * 4)))
+    image_data_lists = []
+    for records in pool.map(
+        extract_records,
+        md_files,
+        [hackmd] * len(md_files),
+        chunksize=chunksize,
+    ):
+        image_data_list = [image_data_from_record(record) for record in records]
+        for image_data in image_data_list:
+            logger.debug("%s", image_data)
+        image_data_lists.append(image_data_list)
+    return image_data_lists
+
+
+DEFAULT_EXCLUDES = (".git", "node_modules")
+
+
+def find_md_files(root, include=("*.md",), exclude=DEFAULT_EXCLUDES):
+    """Walks a directory tree with os.scandir and returns the files matching an
+    include pattern, in a stable order.
+
+    Patterns are fnmatch ones, matched against the path relative to `root`
+    (with "/" separators) when they contain a "/", else against the name. A
+    directory matching an exclude pattern is not entered, and symbolic links
+    to directories are not followed.
+    """
+
+    return [md_file for md_file, _ in scan_md_files(root, include, exclude)]
+
+
+def scan_md_files(root, include=("*.md",), exclude=DEFAULT_EXCLUDES):
+    """Does the walk of find_md_files() and returns (path, os.DirEntry) pairs."""
+
+    def matches(patterns, rel_path, name):
+        return any(
+            fnmatch.fnmatch(rel_path if "/" in pattern else name, pattern)
+            for pattern in patterns
+        )
+
+    md_files = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as error:
+            logger.warning("Cannot list %s: %s", os.path.join(root, rel_dir), error)
+            continue
+        sub_dirs = []
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if matches(exclude, rel_path, entry.name):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                sub_dirs.append(rel_path)
+            elif entry.is_file() and matches(include, rel_path, entry.name):
+                md_files.append((os.path.join(root, rel_path), entry))
+        stack.extend(reversed(sub_dirs))
+    return md_files
+
+
+class MarkdownWatcher:
+    """Polls a directory tree for the markdown files created or changed.
+
+    Each poll walks the tree like find_md_files() and compares the size and
+    modification time of every file with the previous poll. A changed file is
+    reported once it did not change for `debounce` seconds, so that a save
+    written in several steps, or a burst of saves, is migrated once.
+    """
+
+    def __init__(self, root, include=("*.md",), exclude=DEFAULT_EXCLUDES, debounce=2.0):
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.signatures = self._scan()
+        self.changed_at = {}
+
+    def _scan(self):
+        signatures = {}
+        for md_file, entry in scan_md_files(self.root, self.include, self.exclude):
+            try:
+                stat = entry.stat()
+            except OSError:  # removed since it was listed
+                continue
+            signatures[md_file] = (stat.st_size, stat.st_mtime_ns)
+        return signatures
+
+    def poll(self) -> list:
+        """Returns the files which changed and settled since the last polls."""
+        signatures = self._scan()
+        now = time.monotonic()
+        for md_file, signature in signatures.items():
+            if self.signatures.get(md_file) != signature:
+                self.changed_at[md_file] = now
+        self.signatures = signatures
+        ready = []
+        for md_file, changed_at in list(self.changed_at.items()):
+            if md_file not in signatures:
+                del self.changed_at[md_file]
+            elif now - changed_at >= self.debounce:
+                del self.changed_at[md_file]
+                ready.append(md_file)
+        return sorted(ready)
+
+
+def parse_shard(value):
+    """Parses "i/N" into (i, N) with 1 <= i <= N."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"expected 1 <= i <= N, got {value!r}")
+    return index, count
+
+
+def select_shard(md_files, shard):
+    index, count = shard
+    return [md_file for md_file in md_files if shard_of(md_file, count) == index]
+
+
+def folder_name_of(md_file) -> str:
+    """Returns the name of the Drive folder of a markdown file.
+
+    It is the file name without extension, except for the index.md and
+    _index.md of Hugo page bundles, which are named after their directory.
+    """
+    md_file = os.path.normpath(md_file)
+    folder_name = os.path.splitext(os.path.basename(md_file))[0]
+    parent = os.path.basename(os.path.dirname(md_file))
+    if folder_name in ("index", "_index") and parent not in ("", os.pardir):
+        return parent
+    return folder_name
+
+
+def shard_of(md_file, count) -> int:
+    """Returns the shard (1 to count) which handles a markdown file.
+
+    Files are assigned by the name of their Drive folder with a stable hash,
+    so every machine agrees, and the files which share a folder, its listing
+    and its uploads always land in the same shard.
+    """
+    folder_name = folder_name_of(md_file)
+    digest = hashlib.sha256(folder_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def build_http_session(pool_size=16):
+    """Builds a requests session whose keep-alive pool is shared by all downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class DownloadError(Exception):
+    """An image host answered with something else than the image."""
+
+    def __init__(self, url, status):
+        super().__init__(f"HTTP {status} from {url}")
+        self.url = url
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    """A host failed too often lately to be called now."""
+
+    def __init__(self, host):
+        super().__init__(f"circuit open for {host}")
+        self.host = host
+
+
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def is_throttled(error) -> bool:
+    """Tells whether an error is a server asking us to slow down."""
+    if isinstance(error, HttpError):
+        return is_rate_limited(error)
+    return isinstance(error, DownloadError) and error.status == 429
+
+
+def is_transient(error) -> bool:
+    """Tells whether a failed call may succeed if made again later."""
+    if isinstance(error, HttpError):
+        return is_rate_limited(error) or error.resp.status in TRANSIENT_STATUSES
+    if isinstance(error, DownloadError):
+        return error.status in TRANSIENT_STATUSES
+    return isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            httplib2.HttpLib2Error,
+            ConnectionError,
+            TimeoutError,
+        ),
+    )
+
+
+def describe_error(error) -> str:
+    """Returns a short reason for an error, to group the failures of a run."""
+    if isinstance(error, DownloadError):
+        return f"HTTP {error.status}"
+    if isinstance(error, HttpError):
+        return f"Drive HTTP {error.resp.status}"
+    if isinstance(error, CircuitOpenError):
+        return "circuit open"
+    return type(error).__name__
+
+
+def backoff_delay(attempt, base=1.0, cap=64.0) -> float:
+    """Returns the jittered exponential delay before the retry #attempt."""
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+class CircuitBreaker:
+    """Stops calling a host after `threshold` failures in a row.
+
+    The circuit stays open for `cooldown` seconds, during which calls fail
+    fast, then lets one trial call through: it closes the circuit again if it
+    succeeds and opens it for another cooldown if it fails or is throttled.
+    """
+
+    def __init__(self, threshold=5, cooldown=60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self) -> bool:
+        """Records a failure; returns whether it opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            if not self.trial and (
+                self.opened_at is not None or self.failures < self.threshold
+            ):
+                return False
+            self.opened_at = time.monotonic()
+            self.trial = False
+            return True
+
+    def throttled(self):
+        """Records an answer asking us to slow down, which is not a failure of
+        the host, but does not tell that it recovered either."""
+        with self.lock:
+            if self.trial:
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+class RetryScheduler:
+    """Retries the calls to remote hosts, downloads and Drive requests alike.
+
+    A call failing with a transient error (see is_transient) is retried up to
+    `max_retries` times with a jittered exponential backoff. Each host has a
+    CircuitBreaker fed by these failures, except the ones asking us to slow
+    down, so that the calls to a dead host fail fast instead of timing out.
+    """
+
+    def __init__(
+        self,
+        max_retries=4,
+        base_delay=0.5,
+        max_delay=30.0,
+        breaker_threshold=5,
+        breaker_cooldown=60.0,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host) -> CircuitBreaker:
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_cooldown
+                )
+            return self.breakers[host]
+
+    def reset_breakers(self):
+        """Gives every host a new chance, e.g. before retrying deferred work."""
+        with self.lock:
+            breakers = list(self.breakers.values())
+        for breaker in breakers:
+            breaker.success()
+
+    def call(self, host, function, is_retryable=is_transient):
+        breaker = self.breaker(host)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(host)
+            try:
+                result = function()
+            except Exception as error:
+                if not is_retryable(error):
+                    breaker.success()  # the host did answer
+                    raise
+                throttled = is_throttled(error)
+                if throttled:
+                    breaker.throttled()
+                elif breaker.failure():
+                    logger.warning("Too many failures from %s; pause its calls", host)
+                    METRICS.count("circuit_opened", host=host)
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                logger.info("%s failed (%s); retry in %.1fs", host, error, delay)
+                cause = "throttled" if throttled else "transient"
+                METRICS.count("retries", host=host, cause=cause)
+                time.sleep(delay)
+            else:
+                breaker.success()
+                return result
+
+
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)  # seconds to connect, and between two reads
+
+
+def hash_file(file_name):
+    """Computes the sha256 and the size of a local file chunk by chunk."""
+    sha256 = hashlib.sha256()
+    size = 0
+    with METRICS.timer("hash"), open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            size += len(chunk)
+    METRICS.count("bytes", size, stage="hash")
+    return {"sha256": sha256.hexdigest(), "size": size}
+
+
+def download_image(file_name, image_url, session=None, headers=None):
+    """Downloads an image from a URL and saves it to a file.
+
+    The body is streamed to disk and hashed in the same pass; returns the
+    fingerprint of the file and the validators of the response as
+    {"sha256": ..., "size": ..., "etag": ..., "last_modified": ...}. With
+    conditional `headers`, a 304 response returns {"not_modified": True}
+    without touching the file.
+    """
+    try:
+        with (session or requests).get(
+            image_url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            if response.status_code == 304 and headers:
+                logger.debug("Not modified %s", image_url)
+                return {"not_modified": True}
+            if response.status_code != 200:
+                raise DownloadError(image_url, response.status_code)
+            sha256 = hashlib.sha256()
+            size = 0
+            # write to a partial file first so that an interrupted download
+            # never looks like a finished one
+            part_name = file_name + ".part"
+            try:
+                with open(part_name, "wb") as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+                os.replace(part_name, file_name)
+            except BaseException:
+                # the cache does not account for partial files
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(part_name)
+                raise
+            logger.debug("Downloaded %s", image_url)
+            return {
+                "sha256": sha256.hexdigest(),
+                "size": size,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+
+    except DownloadError as error:
+        logger.debug("An error occurred: %s", error)
+        raise
+
+
+def make_host_limit(per_host):
+    """Returns a function giving the semaphore which bounds the concurrent
+    requests to the host of a URL to `per_host`."""
+    host_limits = {}
+    host_limits_lock = threading.Lock()
+
+    def host_limit(url):
+        host = urlsplit(url).netloc
+        with host_limits_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(per_host)
+            return host_limits[host]
+
+    return host_limit
+
+
+def download_all_images(session, jobs, workers=8, per_host=4, retries=None):
+    """Downloads (file_name, image_url[, headers]) jobs on a bounded pool of threads.
+
+    At most `per_host` downloads hit the same host at once, and failed
+    downloads are retried through the `retries` RetryScheduler if given.
+    Returns one result dict per job, in the same order as `jobs`, carrying
+    what download_image() returned; a failed download is recorded in its
+    result, with a short reason in "error", instead of aborting the others.
+    """
+    host_limit = make_host_limit(per_host)
+
+    def download_one(file_name, image_url, headers):
+        # the host slot is only held during an attempt, not between retries
+        def download():
+            with host_limit(image_url):
+                return download_image(file_name, image_url, session, headers)
+
+        with METRICS.timer("download"):
+            if retries is None:
+                return download()
+            return retries.call(urlsplit(image_url).netloc, download)
+
+    results = [
+        {
+            "file_name": job[0],
+            "url": job[1],
+            "headers": job[2] if len(job) > 2 else None,
+            "ok": True,
+            "error": None,
+            "not_modified": False,
+            "sha256": None,
+            "size": None,
+            "etag": None,
+            "last_modified": None,
+        }
+        for job in jobs
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                download_one, result["file_name"], result["url"], result["headers"]
+            ): result
+            for result in results
+        }
+        for future in as_completed(futures):
+            result = futures[future]
+            try:
+                result.update(future.result())
+            except Exception as error:
+                result["ok"] = False
+                result["error"] = describe_error(error)
+                # the host of a circuit open was already reported
+                log = logger.warning
+                if isinstance(error, CircuitOpenError):
+                    log = logger.debug
+                log("Failed to download %s: %s", result["url"], error)
+                METRICS.count("images", stage="download", outcome="failed")
+            else:
+                if result["not_modified"]:
+                    METRICS.count("images", stage="download", outcome="not_modified")
+                else:
+                    METRICS.count("images", stage="download", outcome="downloaded")
+                    METRICS.count("bytes", result["size"], stage="download")
+    return results
+
+
+PROBE_FALLBACK_STATUSES = {400, 403, 405, 501}  # hosts which mishandle HEAD
+DEAD_STATUSES = {404, 410}
+
+
+def probe_url(url, session=None) -> int:
+    """Checks that a URL serves something, without downloading it.
+
+    Sends a HEAD request, or a GET of the first byte when the host does not
+    answer HEAD properly. Returns the status, or raises DownloadError when it
+    is an error.
+    """
+    response = (session or requests).head(
+        url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+    )
+    if response.status_code in PROBE_FALLBACK_STATUSES:
+        with (session or requests).get(
+            url, stream=True, headers={"Range": "bytes=0-0"}, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            pass
+    if response.status_code >= 400:
+        raise DownloadError(url, response.status_code)
+    return response.status_code
+
+
+def probe_all_urls(session, urls, workers=8, per_host=4, retries=None) -> dict:
+    """Probes URLs on a bounded pool of threads like download_all_images().
+
+    Returns the error of each URL which does not answer, or None if it does.
+    """
+    host_limit = make_host_limit(per_host)
+
+    def probe_one(url):
+        def probe():
+            with host_limit(url):
+                return probe_url(url, session)
+
+        with METRICS.timer("probe"):
+            if retries is None:
+                return probe()
+            return retries.call(urlsplit(url).netloc, probe)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(probe_one, url): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                results[futures[future]] = None
+            except Exception as error:
+                results[futures[future]] = error
+    return results
+
+
+IMAGE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    checked_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+CREATE TABLE IF NOT EXISTS derived (
+    source TEXT NOT NULL,
+    options TEXT NOT NULL,
+    sha256 TEXT,
+    PRIMARY KEY (source, options)
+);
+CREATE TABLE IF NOT EXISTS dead_urls (
+    url TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    checked_at REAL NOT NULL
+);
+"""
+
+
+class ImageCache:
+    """A content-addressed store of downloaded images shared by the whole run.
+
+    Each content is stored once under its sha256, and source URLs map to the
+    content they served, so an image embedded in many markdown files is
+    fetched and stored once. When the store grows over `max_bytes`, the least
+    recently used contents are evicted, except the pinned ones which are still
+    waiting for their upload. The URLs found dead by a probe are remembered
+    too, so later runs can skip them.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pinned = {}
+        os.makedirs(os.path.join(cache_dir, "tmp"), exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False
+        )
+        self.db.executescript(IMAGE_CACHE_SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(urls)")}
+        for column, column_type in (
+            ("etag", "TEXT"),
+            ("last_modified", "TEXT"),
+            ("checked_at", "REAL NOT NULL DEFAULT 0"),
+        ):
+            if column not in columns:  # caches created before revalidation
+                self.db.execute(f"ALTER TABLE urls ADD COLUMN {column} {column_type}")
+
+    def path(self, sha256):
+        return os.path.join(self.cache_dir, "objects", sha256[:2], sha256)
+
+    def new_temp_file(self):
+        """Returns a path where a download can be written before put()."""
+        fd, tmp_name = tempfile.mkstemp(
+            dir=os.path.join(self.cache_dir, "tmp"), suffix=".part"
+        )
+        os.close(fd)
+        return tmp_name
+
+    def _pin(self, sha256):
+        self.pinned[sha256] = self.pinned.get(sha256, 0) + 1
+        with self.db:
+            self.db.execute(
+                "UPDATE blobs SET last_used = ? WHERE sha256 = ?",
+                (time.time(), sha256),
+            )
+
+    def get(self, url):
+        """Returns the cached content of a URL and pins it, or None.
+
+        The entry also carries the validators of the response which served it
+        ("etag", "last_modified") and when it was last checked ("checked_at").
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT blobs.sha256, blobs.size, urls.etag, urls.last_modified,"
+                " urls.checked_at FROM urls"
+                " JOIN blobs ON blobs.sha256 = urls.sha256 WHERE urls.url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            sha256, size, etag, last_modified, checked_at = row
+            if not os.path.exists(self.path(sha256)):
+                with self.db:
+                    self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                return None
+            self._pin(sha256)
+            return {
+                "file_name": self.path(sha256),
+                "sha256": sha256,
+                "size": size,
+                "etag": etag,
+                "last_modified": last_modified,
+                "checked_at": checked_at,
+            }
+
+    def checked_at(self, url):
+        """Returns when the cached content of a URL was last checked, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT checked_at FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+            return row[0] if row is not None else None
+
+    def dead_status(self, url, max_age):
+        """Returns the status of a URL found dead less than max_age seconds ago."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status FROM dead_urls WHERE url = ? AND checked_at > ?",
+                (url, time.time() - max_age),
+            ).fetchone()
+            return row[0] if row is not None else None
+
+    def set_dead(self, url, status):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO dead_urls (url, status, checked_at)"
+                " VALUES (?, ?, ?)",
+                (url, status, time.time()),
+            )
+
+    def set_alive(self, url):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM dead_urls WHERE url = ?", (url,))
+
+    def revalidated(self, url):
+        """Records that the source still serves the cached content."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE urls SET checked_at = ? WHERE url = ?", (time.time(), url)
+            )
+
+    def _store(self, tmp_name, sha256, size):
+        file_name = self.path(sha256)
+        if os.path.exists(file_name):
+            os.unlink(tmp_name)
+        else:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            os.replace(tmp_name, file_name)
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, last_used)"
+                " VALUES (?, ?, ?)",
+                (sha256, size, time.time()),
+            )
+        return file_name
+
+    def put(self, url, tmp_name, sha256, size, etag=None, last_modified=None):
+        """Moves a downloaded file into the store and pins it."""
+        with self.lock:
+            file_name = self._store(tmp_name, sha256, size)
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO urls"
+                    " (url, sha256, etag, last_modified, checked_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (url, sha256, etag, last_modified, time.time()),
+                )
+            self._pin(sha256)
+            self._evict()
+            return {"file_name": file_name, "sha256": sha256, "size": size}
+
+    def get_derived(self, source, options):
+        """Returns the cached result of processing a content and pins it.
+
+        Returns None when the content was never processed with these options,
+        and {"sha256": None} when processing it gave nothing better than the
+        content itself.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT derived.sha256, blobs.size FROM derived"
+                " LEFT JOIN blobs ON blobs.sha256 = derived.sha256"
+                " WHERE derived.source = ? AND derived.options = ?",
+                (source, options),
+            ).fetchone()
+            if row is None:
+                return None
+            sha256, size = row
+            if sha256 is None:
+                return {"sha256": None}
+            if size is None or not os.path.exists(self.path(sha256)):
+                with self.db:
+                    self.db.execute(
+                        "DELETE FROM derived WHERE source = ? AND options = ?",
+                        (source, options),
+                    )
+                return None
+            self._pin(sha256)
+            return {"file_name": self.path(sha256), "sha256": sha256, "size": size}
+
+    def put_derived(self, source, options, tmp_name, sha256=None, size=None):
+        """Records the result of processing a content, and moves the processed
+        file into the store and pins it if there is one."""
+        with self.lock:
+            file_name = None
+            if sha256 is not None:
+                file_name = self._store(tmp_name, sha256, size)
+                self._pin(sha256)
+            elif os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO derived (source, options, sha256)"
+                    " VALUES (?, ?, ?)",
+                    (source, options, sha256),
+                )
+            self._evict()
+            return {"file_name": file_name, "sha256": sha256, "size": size}
+
+    def release(self, sha256s):
+        """Unpins contents once they are uploaded."""
+        with self.lock:
+            for sha256 in sha256s:
+                if self.pinned.get(sha256, 0) > 1:
+                    self.pinned[sha256] -= 1
+                else:
+                    self.pinned.pop(sha256, None)
+            self._evict()
+
+    def _evict(self):
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self.db.execute(
+            "SELECT sha256, size FROM blobs ORDER BY last_used"
+        ).fetchall()
+        with self.db:
+            for sha256, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if sha256 in self.pinned:
+                    continue
+                try:
+                    os.unlink(self.path(sha256))
+                except FileNotFoundError:
+                    pass
+                self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM derived WHERE sha256 = ?", (sha256,))
+                total -= size
+
+
+OPTIMIZED_FORMATS = {"webp": "WEBP", "avif": "AVIF"}
+
+
+def optimize_image(
+    src_name, dst_name, image_format=None, max_dimension=None, quality=85
+):
+    """Recompresses an image without its metadata into dst_name, optionally
+    converted to WebP/AVIF and downscaled to fit in max_dimension pixels.
+
+    Runs in a worker process. Returns the sha256 and size of the new file, or
+    None when the image is better uploaded as it is: animated, not an image
+    Pillow reads, or not made smaller.
+    """
+    try:
+        with Image.open(src_name) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                return None
+            save_format = OPTIMIZED_FORMATS.get(image_format, image.format)
+            image = ImageOps.exif_transpose(image)
+            # keep what is needed to render the image, drop EXIF, XMP, text...
+            image.info = {
+                key: value
+                for key, value in image.info.items()
+                if key in ("icc_profile", "transparency")
+            }
+            if max_dimension and max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            if save_format == "JPEG":
+                params = {"quality": quality, "optimize": True, "progressive": True}
+            elif save_format == "PNG":
+                params = {"optimize": True}
+            elif save_format in ("WEBP", "AVIF"):
+                params = {"quality": quality}
+            else:
+                return None
+            if "icc_profile" in image.info:
+                params["icc_profile"] = image.info["icc_profile"]
+            image.save(dst_name, save_format, **params)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        logger.debug("Cannot optimize '%s': %s", src_name, error)
+        return None
+    if os.path.getsize(dst_name) >= os.path.getsize(src_name):
+        return None
+    return hash_file(dst_name)
+
+
+def get_folder_checksum_index(drive_service, folder_id, rate_limiter=None) -> dict:
+    """Lists a folder once and maps the sha256Checksum of each file to its ID."""
+    # Ref: https://developers.google.com/drive/api/guides/search-files?hl=en#specific
+    # we use sha256 Checksum to compare local file and the remote file
+    try:
+        checksum_index = {}
+        page_token = None
+        while True:
+            request = drive_service.files().list(
+                q=f"'{folder_id}' in parents and trashed = false",
+                spaces="drive",
+                fields="nextPageToken, files(id, sha256Checksum)",
+                pageSize=1000,
+                pageToken=page_token,
+            )
+            with METRICS.timer("list"):
+                response = execute_request(request, rate_limiter)
+            for file in response.get("files", []):
+                if file.get("sha256Checksum") is not None:
+                    checksum_index.setdefault(file["sha256Checksum"], file["id"])
+            page_token = response.get("nextPageToken", None)
+            if page_token is None:
+                break
+        return checksum_index
+    except HttpError as error:
+        logger.error("An error occurred: %s", error)
+        raise
+
 
+def get_file_id_if_exist(checksum_index, file_name, sha256=None) -> str:
+    if sha256 is None:
+        sha256 = hash_file(file_name)["sha256"]
+    file_id = checksum_index.get(sha256)
+    if file_id is not None:
+        logger.debug("File '%s' already exists with ID %s.", file_name, file_id)
+    return file_id
+
+
+def is_rate_limited(error) -> bool:
+    """Tells whether an HttpError is Drive asking us to slow down."""
+    # Ref: https://developers.google.com/drive/api/guides/limits
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and (
+        b"userRateLimitExceeded" in error.content
+        or b"rateLimitExceeded" in error.content
+    )
+
+
+class DriveRateLimiter:
+    """Keeps Drive requests just under the per-user quota.
+
+    A token bucket refilled at `rate` requests per second bounds the request
+    rate, and the number of requests in flight follows AIMD: it grows by one
+    for each window of successful requests and halves whenever Drive answers
+    with a rate limit error. Failed requests are retried through `retries`, a
+    RetryScheduler shared with the downloads if given.
+    """
+
+    def __init__(self, rate=10.0, max_concurrency=8, max_retries=6, retries=None):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.retries = retries or RetryScheduler(max_retries, 1.0, 64.0)
+        self.limit = max(1.0, max_concurrency / 2)
+        self.in_flight = 0
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def release(self, rate_limited=False):
+        with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1.0, self.limit / 2)
+                self.tokens = 0
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def execute(self, request):
+        """Executes a googleapiclient request, retrying it when rate limited."""
+        return self.call(request.execute)
+
+    def call(self, function):
+        """Calls a function sending one Drive request, retrying it when it fails."""
+
+        def attempt():
+            self.acquire()
+            try:
+                response = function()
+            except HttpError as error:
+                self.release(is_rate_limited(error))
+                raise
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            return response
+
+        return self.retries.call(DRIVE_HOST, attempt)
+
+
+DRIVE_HOST = "www.googleapis.com"
+# the public URL of an uploaded file, written in the markdown files
+NEW_URL_BASE = "https://lh3.googleusercontent.com/d/"
+MULTIPART_MAX_SIZE = 5 * 2**20  # larger files go through a resumable upload
+RESUMABLE_CHUNK_SIZE = 8 * 2**20  # must be a multiple of 256 KiB
+
+
+def new_url(file_id) -> str:
+    return NEW_URL_BASE + file_id
+
+
+def query_upload_session(http, session_uri, size):
+    """Asks Drive how much of a resumable upload it already has.
+
+    Returns (progress, None) to continue from the byte `progress`, (None, file)
+    when the upload was already complete, or (None, None) when the session has
+    expired.
+    """
+    # Ref: https://developers.google.com/drive/api/guides/manage-uploads#resume-upload
+    resp, content = http.request(
+        session_uri,
+        method="PUT",
+        headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"},
+    )
+    METRICS.count("api_calls", method="upload.query")
+    if resp.status in (200, 201):
+        return None, json.loads(content)
+    if resp.status == 308:
+        received = resp.get("range")  # e.g. "bytes=0-42"
+        return (int(received.rsplit("-", 1)[1]) + 1 if received else 0), None
+    return None, None
+
+
+def upload_one_to_drive(
+    drive_service,
+    folder_id,
+    file_name,
+    rate_limiter=None,
+    name=None,
+    ledger=None,
+    sha256=None,
+) -> str:
+    """Uploads a file with a single multipart request if it is small, else with
+    a chunked resumable upload whose session is kept in the ledger so that an
+    interrupted upload continues from the last byte Drive acknowledged."""
+    file_metadata = {
+        "name": name or os.path.splitext(os.path.basename(file_name))[0],
+        "parents": [folder_id],
+    }
+    call = rate_limiter.call if rate_limiter is not None else (lambda f: f())
+    size = os.path.getsize(file_name)
+
+    if size <= MULTIPART_MAX_SIZE:
+        media = MediaFileUpload(file_name, resumable=False)
+        request = drive_service.files().create(
+            body=file_metadata, media_body=media, fields="id"
+        )
+        file = call(request.execute)
+        logger.debug("File '%s' created with ID %s.", file_name, file.get("id"))
+        return file.get("id")
+
+    media = MediaFileUpload(file_name, chunksize=RESUMABLE_CHUNK_SIZE, resumable=True)
+    request = drive_service.files().create(
+        body=file_metadata, media_body=media, fields="id"
+    )
+    keep_session = ledger is not None and sha256 is not None
+    file = None
+    session_uri = None
+    if keep_session:
+        session_uri = ledger_get_upload_session(ledger, folder_id, sha256)
+    if session_uri is not None:
+        progress, file = call(
+            lambda: query_upload_session(request.http, session_uri, size)
+        )
+        if progress is not None:
+            logger.info("Resume the upload of '%s' from byte %d.", file_name, progress)
+            request.resumable_uri = session_uri
+            request.resumable_progress = progress
+        else:
+            session_uri = None
+    while file is None:
+        _, file = call(request.next_chunk)
+        if keep_session and session_uri is None and request.resumable_uri:
+            session_uri = request.resumable_uri
+            ledger_set_upload_session(ledger, folder_id, sha256, session_uri)
+    if keep_session:
+        ledger_delete_upload_session(ledger, folder_id, sha256)
+    logger.debug("File '%s' created with ID %s.", file_name, file.get("id"))
+    return file.get("id")
+
+
+def upload_all_to_drive(
+    drive_service,
+    folder_id,
+    file_names,
+    checksums=None,
+    checksum_index=None,
+    credentials_file=None,
+    workers=1,
+    rate_limiter=None,
+    names=None,
+    ledger=None,
+    errors=None,
+):
+    """Uploads files missing from the folder and returns their new URLs.
+
+    `checksum_index` maps sha256 to file ID for the folder; it is built with a
+    single listing when not given and is updated as uploads complete. With
+    `credentials_file`, uploads run on `workers` threads, each with its own
+    Drive service. `names` are the names given on Drive, the file names
+    without extension by default. The sessions of large uploads are kept in
+    `ledger` if given. A failed upload gets None as its URL, and the reason
+    of its failure in `errors`, a dict keyed by sha256, if given.
+    """
+    if names is None:
+        names = [None] * len(file_names)
+    if checksums is None:
+        checksums = [hash_file(file_name)["sha256"] for file_name in file_names]
+    try:
+        if checksum_index is None:
+            checksum_index = get_folder_checksum_index(
+                drive_service, folder_id, rate_limiter
+            )
+    except HttpError as error:
+        logger.error("An error occurred: %s", error)
+        raise
+
+    # upload each content once even if it appears several times
+    to_upload = {}
+    for file_name, sha256, name in zip(file_names, checksums, names):
+        if get_file_id_if_exist(checksum_index, file_name, sha256) is None:
+            to_upload.setdefault(sha256, (file_name, name))
+    METRICS.count(
+        "images", len(file_names) - len(to_upload), stage="upload", outcome="reused"
+    )
+
+    def upload_one(file_name, name, sha256):
+        service = drive_service
+        if credentials_file is not None:
+            service = get_drive_service(credentials_file)
+        with METRICS.timer("upload"):
+            file_id = upload_one_to_drive(
+                service, folder_id, file_name, rate_limiter, name, ledger, sha256
+            )
+        METRICS.count("bytes", os.path.getsize(file_name), stage="upload")
+        return file_id
+
+    if credentials_file is None:
+        workers = 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(upload_one, file_name, name, sha256): sha256
+            for sha256, (file_name, name) in to_upload.items()
+        }
+        for future in as_completed(futures):
+            try:
+                checksum_index[futures[future]] = future.result()
+                METRICS.count("images", stage="upload", outcome="uploaded")
+            except Exception as error:
+                logger.error("An error occurred: %s", error)
+                METRICS.count("images", stage="upload", outcome="failed")
+                if errors is not None:
+                    errors[futures[future]] = describe_error(error)
+
+    new_urls = []
+    for sha256 in checksums:
+        file_id = checksum_index.get(sha256)
+        new_urls.append(new_url(file_id) if file_id else None)
+    return new_urls
+
+
+def execute_request(request, rate_limiter=None):
+    """Executes a googleapiclient request, through `rate_limiter` if given."""
+    if rate_limiter is not None:
+        return rate_limiter.execute(request)
+    return request.execute()
+
+
+def get_drive_source(drive_service, drive_id, rate_limiter=None):
+    """Returns the metadata of a Drive file we can copy, or None if we cannot."""
+    request = drive_service.files().get(
+        fileId=drive_id, fields="id, sha256Checksum, size", supportsAllDrives=True
+    )
+    try:
+        return execute_request(request, rate_limiter)
+    except HttpError as error:
+        if error.resp.status in (403, 404):
+            return None
+        raise
+
+
+def copy_all_in_drive(
+    drive_service,
+    folder_id,
+    image_data_list,
+    checksum_index,
+    credentials_file=None,
+    workers=1,
+    rate_limiter=None,
+):
+    """Copies images already hosted on Drive into the folder on the server side.
+
+    Images carry the ID of their source file in "drive_source" and its sha256;
+    a source whose content is already in the folder is not copied again. Each
+    copied image gets its file_id; an image which failed gets an "error"
+    instead.
+    """
+
+    def copy_one(drive_source, name):
+        service = drive_service
+        if credentials_file is not None:
+            service = get_drive_service(credentials_file)
+        request = service.files().copy(
+            fileId=drive_source,
+            body={"name": name, "parents": [folder_id]},
+            fields="id",
+            supportsAllDrives=True,
+        )
+        with METRICS.timer("copy"):
+            if rate_limiter is not None:
+                file = rate_limiter.execute(request)
+            else:
+                file = request.execute()
+        logger.debug("File '%s' copied with ID %s.", drive_source, file.get("id"))
+        return file.get("id")
+
+    to_copy = {}
+    for image_data in image_data_list:
+        sha256 = image_data["sha256"]
+        if get_file_id_if_exist(checksum_index, image_data["old_url"], sha256) is None:
+            to_copy.setdefault(
+                sha256, (image_data["drive_source"], image_data["caption"])
+            )
+    if credentials_file is None:
+        workers = 1
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(copy_one, drive_source, name): sha256
+            for sha256, (drive_source, name) in to_copy.items()
+        }
+        for future in as_completed(futures):
+            try:
+                checksum_index[futures[future]] = future.result()
+                METRICS.count("images", stage="copy", outcome="copied")
+            except Exception as error:
+                logger.error("An error occurred: %s", error)
+                METRICS.count("images", stage="copy", outcome="failed")
+                errors[futures[future]] = describe_error(error)
+    for image_data in image_data_list:
+        if image_data["sha256"] in checksum_index:
+            image_data["file_id"] = checksum_index[image_data["sha256"]]
+        elif image_data["sha256"] in errors:
+            image_data["error"] = errors[image_data["sha256"]]
+
+
+class HTTPStreamUpload(MediaUpload):
+    """Feeds a resumable Drive upload straight from an HTTP response.
+
+    The body is read ahead one chunk at a time and hashed as it is read, so a
+    transfer holds at most about two chunks in memory and nothing touches the
+    disk. Bytes are dropped once Drive has acknowledged them; the lookahead
+    lets size() report the total before the last chunk is sent, as the
+    resumable protocol requires.
+    """
+
+    def __init__(self, response, chunksize=RESUMABLE_CHUNK_SIZE):
+        self._chunks = response.iter_content(CHUNK_SIZE)
+        self._mimetype = response.headers.get(
+            "Content-Type", "application/octet-stream"
+        ).split(";")[0]
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        self._buffer_start = 0  # offset of self._buffer[0] in the body
+        self._next = 0  # offset of the next chunk to be sent
+        self._size = None
+        self.sha256 = hashlib.sha256()
+
+    def _fill(self, end):
+        while self._size is None and self._buffer_start + len(self._buffer) < end:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._size = self._buffer_start + len(self._buffer)
+                break
+            self.sha256.update(chunk)
+            self._buffer += chunk
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        self._fill(self._next + self._chunksize + 1)
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise ValueError(f"Byte {begin} of the stream was already dropped")
+        del self._buffer[: begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length + 1)
+        data = bytes(self._buffer[:length])
+        self._next = begin + len(data)
+        return data
+
+    def has_stream(self):
+        return False
+
+    def to_json(self):
+        raise NotImplementedError("A stream upload cannot be serialized")
+
+
+def transfer_image_to_drive(
+    session, drive_service, folder_id, image_url, name, rate_limiter=None
+):
+    """Streams an image from its host into Drive without a local copy.
+
+    Returns {"file_id": ..., "sha256": ..., "size": ...} of the new file.
+    """
+    call = rate_limiter.call if rate_limiter is not None else (lambda f: f())
+    with session.get(image_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise DownloadError(image_url, response.status_code)
+        media = HTTPStreamUpload(response)
+        request = drive_service.files().create(
+            body={"name": name, "parents": [folder_id]},
+            media_body=media,
+            fields="id",
+        )
+        file = None
+        while file is None:
+            _, file = call(request.next_chunk)
+    logger.debug("Image '%s' streamed to Drive with ID %s.", image_url, file.get("id"))
+    return {
+        "file_id": file["id"],
+        "sha256": media.sha256.hexdigest(),
+        "size": media.size(),
+    }
+
+
+def stream_all_to_drive(
+    session,
+    drive_service,
+    folder_id,
+    image_data_list,
+    checksum_index,
+    credentials_file=None,
+    workers=1,
+    rate_limiter=None,
+    retries=None,
+    per_host=4,
+):
+    """Streams images into the folder and fills their sha256, size and file_id.
+
+    The content is only known once it went through, so a new file which
+    duplicates one already in the folder is deleted afterwards. At most
+    `per_host` transfers read from the same image host at once, like
+    download_all_images(). A transfer which failed on the side of the image
+    host is retried through `retries` if given; an image which failed gets
+    an "error" instead of a file_id.
+    """
+    host_limit = make_host_limit(per_host)
+
+    def transfer_one(image_url, name):
+        service = drive_service
+        if credentials_file is not None:
+            service = get_drive_service(credentials_file)
+
+        def transfer():
+            with host_limit(image_url):
+                return transfer_image_to_drive(
+                    session, service, folder_id, image_url, name, rate_limiter
+                )
+
+        with METRICS.timer("upload"):
+            if retries is None:
+                result = transfer()
+            else:
+                # only the errors of the image host: the Drive ones, HTTP or
+                # transport, were already retried by the rate limiter
+                result = retries.call(
+                    urlsplit(image_url).netloc,
+                    transfer,
+                    lambda error: is_transient(error)
+                    and isinstance(error, (DownloadError, requests.RequestException)),
+                )
+        METRICS.count("bytes", result["size"], stage="download")
+        METRICS.count("bytes", result["size"], stage="upload")
+        file_id = checksum_index.setdefault(result["sha256"], result["file_id"])
+        if file_id != result["file_id"]:
+            logger.debug("Image '%s' already exists with ID %s.", image_url, file_id)
+            request = service.files().delete(fileId=result["file_id"])
+            if rate_limiter is not None:
+                rate_limiter.execute(request)
+            else:
+                request.execute()
+            result["file_id"] = file_id
+        return result
+
+    captions = {}
+    for image_data in image_data_list:
+        captions.setdefault(image_data["url"], image_data["caption"])
+    if credentials_file is None:
+        workers = 1
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(transfer_one, image_url, caption): image_url
+            for image_url, caption in captions.items()
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+                METRICS.count("images", stage="upload", outcome="uploaded")
+            except Exception as error:
+                logger.warning("Failed to stream %s: %s", futures[future], error)
+                METRICS.count("images", stage="upload", outcome="failed")
+                errors[futures[future]] = describe_error(error)
+    for image_data in image_data_list:
+        if image_data["url"] in results:
+            image_data.update(results[image_data["url"]])
+        elif image_data["url"] in errors:
+            image_data["error"] = errors[image_data["url"]]
+
+
+def write_file_atomically(file_name, content):
+    """Replaces a file by writing a temporary file next to it and renaming it.
+
+    `content` is text, written as is without newline translation, or bytes.
+    """
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(file_name)),
+        prefix=f".{os.path.basename(file_name)}.",
+        suffix=".tmp",
+    )
+    try:
+        if isinstance(content, bytes):
+            f = os.fdopen(fd, "wb")
+        else:
+            f = os.fdopen(fd, "w", newline="")
+        with f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(file_name):
+            shutil.copymode(file_name, tmp_name)
+        else:  # mkstemp makes the file private
+            os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+# a URL ends where no URL character follows it; punctuation right after it,
+# e.g. at the end of a sentence, ends it too unless more of the URL follows.
+# \s of a bytes pattern only matches ASCII whitespace, so the UTF-8 encodings
+# of the others are listed for the files read by mmap
+URL_END_PATTERN = (
+    "(?![\\w\\-/#@$&+=%~]|[^\\x00-\\x7f\\s]"
+    "|[.,;:!?]+(?![.,;:!?\\s)\"'<>\\]|}]|\\Z))"
+)
+UNICODE_SPACES_BYTES = b"|".join(
+    chr(code).encode() for code in range(0x80, 0x3001) if chr(code).isspace()
+)
+URL_END_BYTES_PATTERN = (
+    b"(?![\\w\\-/#@$&+=%~]|(?!"
+    + UNICODE_SPACES_BYTES
+    + b")[\\x80-\\xff]|[.,;:!?]+(?![.,;:!?\\s)\"'<>\\]|}]|\\Z|"
+    + UNICODE_SPACES_BYTES
+    + b"))"
+)
+
+
+# Replace old URLs with new URLs in Markdown file
+def replace_urls_in_md(old_urls, new_urls, md_file) -> bool:
+    """Rewrites all the URLs in one pass; returns whether the file changed.
+
+    The longest old URL wins where several start at the same place, and an old
+    URL only matches a whole URL, never the beginning of a longer one. The file
+    is left untouched when nothing changed. A large file is read through mmap
+    and rewritten as bytes. Runs in a worker process for large runs.
+    """
+    url_map = {
+        old_url: new_url
+        for old_url, new_url in zip(old_urls, new_urls)
+        if old_url != new_url
+    }
+    if not url_map:
+        return False
+    old_urls = sorted(url_map, key=len, reverse=True)
+
+    if os.path.getsize(md_file) >= MMAP_THRESHOLD:
+        url_map = {
+            old_url.encode(): new_url.encode() for old_url, new_url in url_map.items()
+        }
+        pattern = re.compile(
+            b"(?:"
+            + b"|".join(re.escape(url.encode()) for url in old_urls)
+            + b")"
+            + URL_END_BYTES_PATTERN
+        )
+        with open(md_file, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as md_content:
+            new_content, count = pattern.subn(
+                lambda match: url_map[match.group(0)], md_content
+            )
+    else:
+        pattern = re.compile(
+            "(?:" + "|".join(re.escape(url) for url in old_urls) + ")" + URL_END_PATTERN
+        )
+        with open(md_file, "r", newline="") as f:
+            md_content = f.read()
+        new_content, count = pattern.subn(
+            lambda match: url_map[match.group(0)], md_content
+        )
+    if count == 0:
+        return False
+
+    write_file_atomically(md_file, new_content)
+    return True
+
+
+DISCOVERY_CACHE_FILE = os.path.join(".cache", "drive_v3_discovery.json")
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+_credentials_cache = {}
+_credentials_lock = threading.Lock()
+_discovery_document = None
+_thread_local = threading.local()
+_idle_drive_services = {}  # credentials file -> services of finished threads
+_idle_drive_services_lock = threading.Lock()
+
+
+def load_credentials(credentials_file):
+    """Loads the service account credentials once and shares them in the run."""
+    with _credentials_lock:
+        if credentials_file not in _credentials_cache:
+            with open(credentials_file, "r") as f:
+                credentials = json.load(f)
+            _credentials_cache[credentials_file] = (
+                service_account.Credentials.from_service_account_info(
+                    credentials, scopes=DRIVE_SCOPES
+                )
+            )
+        return _credentials_cache[credentials_file]
+
+
+def load_discovery_document(cache_file=DISCOVERY_CACHE_FILE):
+    """Loads the Drive v3 discovery document from the local cache.
+
+    The cache is filled from the document shipped with googleapiclient, or from
+    the discovery service if the installed version does not ship one.
+    """
+    global _discovery_document
+    if _discovery_document is not None:
+        return _discovery_document
+    if os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            document = f.read()
+    else:
+        document = get_static_doc("drive", "v3")
+        if document is None:
+            response = requests.get(
+                "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
+            )
+            response.raise_for_status()
+            document = response.text
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w") as f:
+            f.write(document)
+    _discovery_document = document
+    return document
+
+
+class MeteredHttpRequest(HttpRequest):
+    """A googleapiclient request which records its calls in METRICS."""
+
+    def _metered(self, function, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(**kwargs)
+        except HttpError as error:
+            METRICS.count("api_errors", method=self.methodId, status=error.resp.status)
+            raise
+        finally:
+            METRICS.count("api_calls", method=self.methodId)
+            METRICS.observe(
+                "api_seconds", time.perf_counter() - start, method=self.methodId
+            )
+
+    def execute(self, http=None, num_retries=0):
+        return self._metered(super().execute, http=http, num_retries=num_retries)
+
+    def next_chunk(self, http=None, num_retries=0):
+        return self._metered(super().next_chunk, http=http, num_retries=num_retries)
+
+
+def build_drive_service(credentials_file):
+    """Builds a Drive service with its own authorized HTTP transport.
+
+    httplib2 transports are not thread-safe, so a service must not be shared
+    between threads; use get_drive_service() to get the one of this thread.
+    """
+    try:
+        credentials = load_credentials(credentials_file)
+        http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=60))
+        drive_service = build_from_document(
+            load_discovery_document(), http=http, requestBuilder=MeteredHttpRequest
+        )
+        return drive_service
+    except HttpError as error:
+        logger.error("An error occurred: %s", error)
+        raise
+
+
+def get_drive_service(credentials_file):
+    """Returns the Drive service of the calling thread, building it on first use.
+
+    Once a thread is gone, its service and the connections it keeps alive are
+    handed to the next thread which needs one, since worker threads come and
+    go with each batch of markdown files.
+    """
+    services = getattr(_thread_local, "drive_services", None)
+    if services is None:
+        services = _thread_local.drive_services = {}
+    if credentials_file not in services:
+        with _idle_drive_services_lock:
+            idle = _idle_drive_services.get(credentials_file)
+            service = idle.pop() if idle else None
+        if service is None:
+            service = build_drive_service(credentials_file)
+        services[credentials_file] = service
+        weakref.finalize(
+            threading.current_thread(), release_drive_service, credentials_file, service
+        ).atexit = False
+    return services[credentials_file]
+
+
+def release_drive_service(credentials_file, service):
+    with _idle_drive_services_lock:
+        _idle_drive_services.setdefault(credentials_file, []).append(service)
+
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+BATCH_SIZE = 100  # the maximum number of calls in one Drive batch request
+
+
+def get_folder_index(drive_service, parent_id, rate_limiter=None) -> dict:
+    """Lists the child folders of `parent_id` once and maps their names to IDs."""
+    # Ref: https://developers.google.com/drive/api/guides/search-files?hl=en#specific
+    try:
+        folder_index = {}
+        page_token = None
+        while True:
+            request = drive_service.files().list(
+                q=f"mimeType = '{FOLDER_MIME_TYPE}' and '{parent_id}' in parents"
+                " and trashed = false",
+                spaces="drive",
+                fields="nextPageToken, files(id, name)",
+                pageSize=1000,
+                pageToken=page_token,
+            )
+            with METRICS.timer("list"):
+                response = execute_request(request, rate_limiter)
+            for folder in response.get("files", []):
+                folder_index.setdefault(folder["name"], folder["id"])
+            page_token = response.get("nextPageToken", None)
+            if page_token is None:
+                break
+        return folder_index
+    except HttpError as error:
+        logger.error("An error occurred: %s", error)
+        raise
+
+
+def get_folder_id_if_exist(folder_index, folder_name):
+    folder_id = folder_index.get(folder_name)
+    if folder_id is not None:
+        logger.debug("Folder '%s' already exists with ID %s.", folder_name, folder_id)
+    return folder_id
+
+
+def create_folders(
+    drive_service, folder_names, parent_id, folder_index, rate_limiter=None
+):
+    """Creates the folders missing from `folder_index` with batch requests.
+
+    `folder_index` is updated with the created folders. A folder which fails in
+    the batch, or whose whole batch still fails once retried through
+    `rate_limiter`, is left out of the index and created later one by one.
+    """
+    # Ref: https://developers.google.com/drive/api/guides/performance#batch-requests
+    missing = sorted(set(folder_names) - set(folder_index))
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logger.error("An error occurred: %s", exception)
+            return
+        folder_index[request_id] = response.get("id")
+        logger.info("Folder '%s' created with ID %s.", request_id, response.get("id"))
+
+    def execute_batch(folder_names):
+        batch = drive_service.new_batch_http_request(callback=callback)
+        for folder_name in folder_names:
+            folder_metadata = {
+                "name": folder_name,
+                "mimeType": FOLDER_MIME_TYPE,
+                "parents": [parent_id],
+            }
+            batch.add(
+                drive_service.files().create(body=folder_metadata, fields="id"),
+                request_id=folder_name,
+            )
+        start = time.perf_counter()
+        try:
+            batch.execute()
+        finally:
+            METRICS.count("api_calls", method="batch")
+            METRICS.observe("api_seconds", time.perf_counter() - start, method="batch")
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        folder_names = missing[start : start + BATCH_SIZE]
+        try:
+            if rate_limiter is not None:
+                # a batch which failed as a whole created none of its folders
+                rate_limiter.call(functools.partial(execute_batch, folder_names))
+            else:
+                execute_batch(folder_names)
+        except Exception as error:
+            logger.error(
+                "Cannot create %d folder(s) in a batch: %s",
+                len(folder_names),
+                describe_error(error),
+            )
+
+
+def get_or_create_folder(
+    drive_service, folder_name, parent_id, folder_index=None, rate_limiter=None
+):
+    if folder_index is None:
+        folder_index = get_folder_index(drive_service, parent_id, rate_limiter)
+    folder_id = get_folder_id_if_exist(folder_index, folder_name)
+    if folder_id is not None:
+        return folder_id
+
+    try:
+        # Create one
+        folder_metadata = {
+            "name": folder_name,
+            "mimeType": FOLDER_MIME_TYPE,
+            "parents": [parent_id],
+        }
+        folder = execute_request(
+            drive_service.files().create(body=folder_metadata, fields="id"),
+            rate_limiter,
+        )
+        logger.info("Folder '%s' created with ID %s.", folder_name, folder.get("id"))
+        folder_index[folder_name] = folder.get("id")
+        return folder.get("id")
+    except HttpError as error:
+        logger.error("An error occurred: %s", error)
+        raise
+
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS run_files (
+    run_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    md_file TEXT NOT NULL,
+    PRIMARY KEY (run_id, position)
+);
+CREATE TABLE IF NOT EXISTS md_files (
+    md_file TEXT PRIMARY KEY,
+    folder_id TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    folder_id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    session_uri TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (folder_id, sha256)
+);
+CREATE TABLE IF NOT EXISTS images (
+    md_file TEXT NOT NULL,
+    old_url TEXT NOT NULL,
+    url TEXT NOT NULL,
+    sha256 TEXT,
+    folder_id TEXT,
+    file_id TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (md_file, old_url)
+);
+"""
+
+
+_ledger_lock = threading.Lock()
+
+
+def open_ledger(ledger_file):
+    """Opens (or creates) the SQLite ledger which records the transfer progress.
+
+    Markdown files go through "pending" -> "done" and images go through
+    "downloaded" -> "uploaded" -> "rewritten".
+    """
+    # the pipeline stages write from their own threads, see _ledger_lock
+    ledger = sqlite3.connect(ledger_file, check_same_thread=False)
+    ledger.row_factory = sqlite3.Row
+    ledger.executescript(LEDGER_SCHEMA)
+    columns = {row[1] for row in ledger.execute("PRAGMA table_info(md_files)")}
+    for column, column_type in (
+        ("size", "INTEGER"),
+        ("mtime_ns", "INTEGER"),
+        ("sha256", "TEXT"),
+    ):
+        if column not in columns:  # ledgers created before the manifest
+            ledger.execute(f"ALTER TABLE md_files ADD COLUMN {column} {column_type}")
+    return ledger
+
+
+def ledger_start_run(ledger, md_files) -> int:
+    with _ledger_lock, ledger:
+        run_id = ledger.execute(
+            "INSERT INTO runs (started_at) VALUES (?)", (time.time(),)
+        ).lastrowid
+        ledger.executemany(
+            "INSERT INTO run_files (run_id, position, md_file) VALUES (?, ?, ?)",
+            [(run_id, position, md_file) for position, md_file in enumerate(md_files)],
+        )
+    return run_id
+
+
+def ledger_finish_run(ledger, run_id):
+    with _ledger_lock, ledger:
+        ledger.execute(
+            "UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), run_id)
+        )
+
+
+def ledger_last_run_files(ledger):
+    """Returns the markdown files of the latest run which are not done yet."""
+    row = ledger.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+    if row is None:
+        return []
+    rows = ledger.execute(
+        "SELECT run_files.md_file FROM run_files"
+        " LEFT JOIN md_files ON md_files.md_file = run_files.md_file"
+        " WHERE run_files.run_id = ?"
+        " AND (md_files.status IS NULL OR md_files.status != 'done')"
+        " ORDER BY run_files.position",
+        (row["id"],),
+    ).fetchall()
+    return [row["md_file"] for row in rows]
+
+
+def ledger_is_md_unchanged(ledger, md_file, stat) -> bool:
+    """Tells whether a markdown file is done and unchanged since.
+
+    The size and mtime recorded when it was done are compared with `stat`, so
+    the file is not even opened; only when the mtime moved alone (a checkout,
+    a touch) is its content hashed and compared.
+    """
+    row = ledger.execute(
+        "SELECT status, size, mtime_ns, sha256 FROM md_files WHERE md_file = ?",
+        (md_file,),
+    ).fetchone()
+    if row is None or row["status"] != "done" or row["size"] != stat.st_size:
+        return False
+    if row["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    if row["sha256"] is None or hash_file(md_file)["sha256"] != row["sha256"]:
+        return False
+    ledger_set_manifest(ledger, md_file, stat, row["sha256"])
+    return True
+
+
+def ledger_set_manifest(ledger, md_file, stat=None, sha256=None):
+    """Records the size, mtime and content hash of a markdown file."""
+    if stat is None:
+        stat = os.stat(md_file)  # before hashing, so a later change is seen
+    if sha256 is None:
+        sha256 = hash_file(md_file)["sha256"]
+    with _ledger_lock, ledger:
+        ledger.execute(
+            "UPDATE md_files SET size = ?, mtime_ns = ?, sha256 = ?"
+            " WHERE md_file = ?",
+            (stat.st_size, stat.st_mtime_ns, sha256, md_file),
+        )
+
+
+def ledger_set_md(ledger, md_file, status, folder_id=None):
+    with _ledger_lock, ledger:
+        ledger.execute(
+            "INSERT INTO md_files (md_file, folder_id, status, updated_at)"
+            " VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (md_file) DO UPDATE SET"
+            " folder_id = COALESCE(excluded.folder_id, folder_id),"
+            " status = excluded.status, updated_at = excluded.updated_at",
+            (md_file, folder_id, status, time.time()),
+        )
+
+
+def ledger_get_images(ledger, md_file) -> dict:
+    """Returns the recorded images of a markdown file keyed by their old URLs."""
+    rows = ledger.execute("SELECT * FROM images WHERE md_file = ?", (md_file,))
+    return {row["old_url"]: dict(row) for row in rows}
+
+
+def ledger_set_images(ledger, md_file, image_data_list, status, folder_id=None):
+    with _ledger_lock, ledger:
+        ledger.executemany(
+            "INSERT INTO images"
+            " (md_file, old_url, url, sha256, folder_id, file_id, status, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (md_file, old_url) DO UPDATE SET"
+            " url = excluded.url,"
+            " sha256 = COALESCE(excluded.sha256, sha256),"
+            " folder_id = COALESCE(excluded.folder_id, folder_id),"
+            " file_id = COALESCE(excluded.file_id, file_id),"
+            " status = excluded.status, updated_at = excluded.updated_at",
+            [
+                (
+                    md_file,
+                    image_data["old_url"],
+                    image_data["url"],
+                    image_data.get("sha256"),
+                    folder_id,
+                    image_data.get("file_id"),
+                    status,
+                    time.time(),
+                )
+                for image_data in image_data_list
+            ],
+        )
+
+
+def ledger_get_upload_session(ledger, folder_id, sha256):
+    """Returns the URI of an unfinished resumable upload, if any.
+
+    Drive keeps a resumable session for a week, older ones are dropped.
+    """
+    with _ledger_lock:
+        row = ledger.execute(
+            "SELECT session_uri FROM upload_sessions"
+            " WHERE folder_id = ? AND sha256 = ? AND created_at > ?",
+            (folder_id, sha256, time.time() - 7 * 24 * 60 * 60),
+        ).fetchone()
+    return None if row is None else row["session_uri"]
+
+
+def ledger_set_upload_session(ledger, folder_id, sha256, session_uri):
+    with _ledger_lock, ledger:
+        ledger.execute(
+            "INSERT OR REPLACE INTO upload_sessions"
+            " (folder_id, sha256, session_uri, created_at) VALUES (?, ?, ?, ?)",
+            (folder_id, sha256, session_uri, time.time()),
+        )
+
+
+def ledger_delete_upload_session(ledger, folder_id, sha256):
+    with _ledger_lock, ledger:
+        ledger.execute(
+            "DELETE FROM upload_sessions WHERE folder_id = ? AND sha256 = ?",
+            (folder_id, sha256),
+        )
+
+
+def ledger_merge(ledger, other_file):
+    """Merges the markdown files and images recorded in another ledger, e.g. the
+    one of a shard, into this one.
+
+    A markdown file which is done, or an image which has a Drive file, is never
+    replaced by a record which has not; otherwise the latest record wins.
+    """
+    open_ledger(other_file).close()  # bring an older ledger to the schema
+    ledger.execute("ATTACH DATABASE ? AS other", (other_file,))
+    try:
+        with _ledger_lock, ledger:
+            ledger.execute(
+                "INSERT INTO md_files"
+                " (md_file, folder_id, status, updated_at, size, mtime_ns, sha256)"
+                " SELECT md_file, folder_id, status, updated_at, size, mtime_ns,"
+                " sha256 FROM other.md_files WHERE true"
+                " ON CONFLICT (md_file) DO UPDATE SET"
+                " folder_id = COALESCE(excluded.folder_id, folder_id),"
+                " status = excluded.status, updated_at = excluded.updated_at,"
+                " size = excluded.size, mtime_ns = excluded.mtime_ns,"
+                " sha256 = excluded.sha256"
+                " WHERE (excluded.status = 'done') > (status = 'done')"
+                " OR ((excluded.status = 'done') = (status = 'done')"
+                " AND excluded.updated_at > updated_at)"
+            )
+            ledger.execute(
+                "INSERT INTO images (md_file, old_url, url, sha256, folder_id,"
+                " file_id, status, updated_at)"
+                " SELECT md_file, old_url, url, sha256, folder_id, file_id, status,"
+                " updated_at FROM other.images WHERE true"
+                " ON CONFLICT (md_file, old_url) DO UPDATE SET"
+                " url = excluded.url, sha256 = excluded.sha256,"
+                " folder_id = excluded.folder_id, file_id = excluded.file_id,"
+                " status = excluded.status, updated_at = excluded.updated_at"
+                " WHERE (excluded.file_id IS NOT NULL) > (file_id IS NOT NULL)"
+                " OR ((excluded.file_id IS NOT NULL) = (file_id IS NOT NULL)"
+                " AND excluded.updated_at > updated_at)"
+            )
+    finally:
+        ledger.execute("DETACH DATABASE other")
+
+
+def print_ledger_report(ledger):
+    print("Markdown files:")
+    for row in ledger.execute(
+        "SELECT status, COUNT(*) AS n FROM md_files GROUP BY status ORDER BY status"
+    ):
+        print(f"  {row['status']}: {row['n']}")
+    print("Images:")
+    for row in ledger.execute(
+        "SELECT status, COUNT(*) AS n FROM images GROUP BY status ORDER BY status"
+    ):
+        print(f"  {row['status']}: {row['n']}")
+    row = ledger.execute(
+        "SELECT id, started_at, finished_at FROM runs ORDER BY id DESC LIMIT 1"
+    ).fetchone()
+    if row is not None:
+        total = ledger.execute(
+            "SELECT COUNT(*) FROM run_files WHERE run_id = ?", (row["id"],)
+        ).fetchone()[0]
+        remaining = len(ledger_last_run_files(ledger))
+        state = "finished" if row["finished_at"] is not None else "interrupted"
+        print(
+            f"Last run #{row['id']} ({state}):"
+            f" {total - remaining}/{total} markdown file(s) done"
+        )
+
+
+def probe_stage(job, ctx):
+    """Drops the images of a markdown file whose source is dead before they
+    take download slots; the URLs found dead are remembered for a while.
+
+    Only a client error answer counts: a source which cannot be checked, e.g.
+    after 5xx answers, a timeout or with its circuit open, goes on to the
+    download stage, which has its own retries.
+    """
+    args, cache = ctx["args"], ctx["cache"]
+    md_file = job["md_file"]
+    failed = {}
+    to_probe = set()
+    seen = set()
+    now = time.time()
+    for image_data in job["image_data_list"]:
+        image_url = image_data["url"]
+        if "drive_id" in image_data or image_url in seen:
+            continue
+        seen.add(image_url)
+        status = cache.dead_status(image_url, args.dead_link_ttl)
+        if status is not None:
+            failed[image_url] = f"HTTP {status}"
+            METRICS.count("images", stage="probe", outcome="known_dead")
+            continue
+        checked_at = cache.checked_at(image_url)
+        if checked_at is None or now - checked_at >= args.cache_max_age:
+            to_probe.add(image_url)
+    if to_probe:
+        logger.info("> Probe %d source(s) of %s", len(to_probe), md_file)
+    results = probe_all_urls(
+        ctx["session"], to_probe, args.download_workers, args.per_host, ctx["retries"]
+    )
+    for image_url, error in results.items():
+        if error is None:
+            cache.set_alive(image_url)
+            METRICS.count("images", stage="probe", outcome="alive")
+            continue
+        if not isinstance(error, DownloadError) or not (
+            400 <= error.status < 500 and not is_transient(error)
+        ):
+            logger.debug("Cannot probe %s: %s", image_url, describe_error(error))
+            METRICS.count("images", stage="probe", outcome="unverified")
+            continue
+        if error.status in DEAD_STATUSES:
+            cache.set_dead(image_url, error.status)
+            METRICS.count("images", stage="probe", outcome="dead")
+        else:
+            METRICS.count("images", stage="probe", outcome="failed")
+        failed[image_url] = describe_error(error)
+    if failed:
+        logger.warning("> %d source(s) of %s are dead", len(failed), md_file)
+        ledger_set_images(
+            ctx["ledger"],
+            md_file,
+            [
+                image_data
+                for image_data in job["image_data_list"]
+                if image_data["url"] in failed
+            ],
+            "failed",
+        )
+        job["image_data_list"] = [
+            image_data
+            for image_data in job["image_data_list"]
+            if image_data["url"] not in failed
+        ]
+        job["failed"].update(failed)
+    return job
 
-def get_image_data_list_from_md(md_file):
-    """Extracts image URLs and their captions from a Markdown file."""
-    with open(md_file, "r") as f:
-        md_content = f.read()
 
-    pattern = r"!\[(.*)\]\(((?!https://drive.google.com).*?)( \".*\")?\)"
-    matches = re.findall(pattern, md_content)
+def download_stage(job, ctx):
+    """Downloads the images of a markdown file and fingerprints them."""
+    args, ledger = ctx["args"], ctx["ledger"]
+    md_file = job["md_file"]
+    logger.info("Process #%d %s", job["idx"] + 1, md_file)
+    if job["uploaded_list"]:
+        logger.info(
+            "> %d image(s) already uploaded in the ledger", len(job["uploaded_list"])
+        )
 
-    cnt = 0  # for anonymous images and avoid images with same caption
+    # images already on Drive are copied on the server side when we can read
+    # their source; the others are downloaded from lh3.googleusercontent.com
+    copy_list = []
     image_data_list = []
-    for match in matches:
-        image_caption = match[0]
-        if image_caption.strip() != "":
-            image_caption = (
-                "".join([x if x.isalnum() else "_" for x in image_caption])[:100]
-                + f"_{cnt}"
+    for image_data in job["image_data_list"]:
+        drive_source = None
+        if "drive_id" in image_data:
+            drive_source = get_drive_source(
+                get_drive_service(args.credentials),
+                image_data["drive_id"],
+                ctx["rate_limiter"],
             )
+        if drive_source is not None and drive_source.get("sha256Checksum"):
+            image_data["drive_source"] = drive_source["id"]
+            image_data["sha256"] = drive_source["sha256Checksum"]
+            image_data["size"] = int(drive_source.get("size", 0))
+            copy_list.append(image_data)
         else:
-            image_caption = os.path.splitext(os.path.basename(md_file))[0] + f"_{cnt}"
-        cnt += 1
+            image_data_list.append(image_data)
+    job["copy_list"] = copy_list
+    job["image_data_list"] = image_data_list
 
-        image_url: str = match[1]
-        if not image_url.startswith("http"):
-            continue
-        image_data = {"caption": image_caption, "url": image_url, "old_url": image_url}
-        print(image_data)
-        image_data_list.append(image_data)
+    if args.stream:
+        # images go from their hosts to Drive in the upload stage
+        job["pinned"] = []
+        return job
 
-    # Special case for google drive images
-    pattern = r"!\[(.*)\]\((https://drive.google.com/open.+id=([^\"]+?))( \".*\")?\)"
-    matches = re.findall(pattern, md_content)
-    for match in matches:
-        image_caption = match[0]
-        if image_caption.strip() != "":
-            image_caption = (
-                "".join([x if x.isalnum() else "_" for x in image_caption])[:100]
-                + f"_{cnt}"
+    logger.info("> Download all images of %s", md_file)
+    cache = ctx["cache"]
+    entries = {}
+    stale = {}
+    jobs = []
+    now = time.time()
+    for image_url in dict.fromkeys(image_data["url"] for image_data in image_data_list):
+        entry = cache.get(image_url)
+        if entry is not None and now - entry["checked_at"] < args.cache_max_age:
+            entries[image_url] = entry
+            continue
+        # revalidate a stale entry with a conditional request
+        headers = {}
+        if entry is not None:
+            stale[image_url] = entry
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        jobs.append((cache.new_temp_file(), image_url, headers or None))
+    results = download_all_images(
+        ctx["session"], jobs, args.download_workers, args.per_host, ctx["retries"]
+    )
+    failed = {}
+    for result in results:
+        image_url = result["url"]
+        if result["ok"] and result["not_modified"]:
+            cache.revalidated(image_url)
+            entries[image_url] = stale.pop(image_url)
+        elif result["ok"]:
+            entries[image_url] = cache.put(
+                image_url,
+                result["file_name"],
+                result["sha256"],
+                result["size"],
+                result["etag"],
+                result["last_modified"],
             )
+        elif image_url in stale:
+            logger.info("> Use the cached copy of %s", image_url)
+            entries[image_url] = stale.pop(image_url)
         else:
-            image_caption = os.path.splitext(os.path.basename(md_file))[0] + f"_{cnt}"
-        cnt += 1
-        image_old_url = match[1]
-        image_url = "https://lh3.googleusercontent.com/d/" + match[2]
-        image_data = {
-            "caption": image_caption,
-            "url": image_url,
-            "old_url": image_old_url,
-        }
-        print(image_data)
-        image_data_list.append(image_data)
+            failed[image_url] = result["error"]
+        if os.path.exists(result["file_name"]):  # not moved into the cache
+            os.unlink(result["file_name"])
+    # the contents replaced by a new download are not needed anymore
+    cache.release([entry["sha256"] for entry in stale.values()])
+    if failed:
+        logger.warning("> %d image(s) of %s failed to download", len(failed), md_file)
+        ledger_set_images(
+            ledger,
+            md_file,
+            [
+                image_data
+                for image_data in image_data_list
+                if image_data["url"] in failed
+            ],
+            "failed",
+        )
+        image_data_list = [
+            image_data
+            for image_data in image_data_list
+            if image_data["url"] not in failed
+        ]
+    for image_data in image_data_list:
+        image_data.update(entries[image_data["url"]])
+    # one pin per URL taken from the cache, released after the upload
+    job["pinned"] = [entry["sha256"] for entry in entries.values()]
+    ledger_set_images(ledger, md_file, image_data_list, "downloaded")
+    job["image_data_list"] = image_data_list
+    job["failed"].update(failed)
+    return job
 
-    # Special case for title images
-    # we do not need to download images hosted on unsplash
-    pattern = r"image = \"((?!https://images.unsplash.com).+)\""
-    matches = re.findall(pattern, md_content)
-    for match in matches:
-        image_caption = f"{os.path.splitext(os.path.basename(md_file))[0]}_banner"
-        image_url = match
-        image_data = {
-            "caption": image_caption,
-            "url": image_url,
-            "old_url": image_url,
-        }
-        print(image_data)
-        image_data_list.append(image_data)
 
-    return image_data_list
+def optimize_stage(job, ctx):
+    """Recompresses the downloaded images of a markdown file on the process
+    pool, reusing the results cached for the same content and options."""
+    md_file = job["md_file"]
+    image_data_list = job["image_data_list"]
+    if not image_data_list:
+        return job
+    logger.info("> Optimize the images of %s", md_file)
+    cache = ctx["cache"]
+    options = json.dumps(ctx["optimize_options"], sort_keys=True)
+    results = {}
+    futures = {}
+    for image_data in image_data_list:
+        sha256 = image_data["sha256"]
+        if sha256 in results:
+            continue
+        results[sha256] = cache.get_derived(sha256, options)
+        if results[sha256] is None:
+            tmp_name = cache.new_temp_file()
+            future = ctx["process_pool"].submit(
+                optimize_image,
+                image_data["file_name"],
+                tmp_name,
+                **ctx["optimize_options"],
+            )
+            futures[future] = (sha256, tmp_name)
+    for future in as_completed(futures):
+        sha256, tmp_name = futures[future]
+        try:
+            optimized = future.result() or {}
+        except Exception as error:  # a worker died, keep the source this time
+            logger.warning("Cannot optimize '%s': %s", sha256, error)
+            os.unlink(tmp_name)
+            continue
+        results[sha256] = cache.put_derived(sha256, options, tmp_name, **optimized)
 
+    size_before = size_after = 0
+    for image_data in image_data_list:
+        result = results[image_data["sha256"]]
+        size_before += image_data["size"]
+        if result is not None and result["sha256"] is not None:
+            image_data["file_name"] = result["file_name"]
+            image_data["sha256"] = result["sha256"]
+            image_data["size"] = result["size"]
+        size_after += image_data["size"]
+    # one pin per processed content taken from the cache
+    job["pinned"].extend(
+        result["sha256"]
+        for result in results.values()
+        if result is not None and result["sha256"] is not None
+    )
+    logger.info(
+        "> Images of %s optimized from %d to %d bytes", md_file, size_before, size_after
+    )
+    return job
 
-def get_imgur_data_list_from_md(md_file):
-    """ used for HackMD """
-    with open(md_file, "r") as f:
-        md_content = f.read()
-    
-    cnt = 0  # for anonymous images and avoid images with same caption
-    image_data_list = []
 
-    pattern = r"(https?://(i.)?imgur.com/[^\ \n)\"]*)"
-    matches = re.findall(pattern, md_content)
+def release_pins(job, ctx):
+    """Releases the cache entries pinned for a job, once."""
+    if job.get("pinned"):
+        ctx["cache"].release(job["pinned"])
+        job["pinned"] = []
 
-    cnt = 0  # for anonymous images and avoid images with same caption
-    image_data_list = []
-    for match in matches:
-        image_caption = ""
-        if image_caption.strip() != "":
-            image_caption = (
-                "".join([x if x.isalnum() else "_" for x in image_caption])[:100]
-                + f"_{cnt}"
+
+def upload_stage(job, ctx):
+    """Uploads the downloaded images of a markdown file to its folder."""
+    args, ledger = ctx["args"], ctx["ledger"]
+    md_file = job["md_file"]
+    image_data_list = job["image_data_list"]
+    copy_list = job["copy_list"]
+    if not image_data_list and not copy_list:
+        release_pins(job, ctx)
+        return job
+    # the downloaded files stay pinned in the cache until uploaded, or until
+    # the upload failed
+    try:
+        drive_service = get_drive_service(args.credentials)
+        folder_name = folder_name_of(md_file)
+        if ctx["folder_index"] is None:  # could not be listed before the run
+            ctx["folder_index"] = get_folder_index(
+                drive_service, ctx["root_id"], ctx["rate_limiter"]
+            )
+        folder_id = get_or_create_folder(
+            drive_service,
+            folder_name,
+            ctx["root_id"],
+            ctx["folder_index"],
+            ctx["rate_limiter"],
+        )
+        ledger_set_md(ledger, md_file, "pending", folder_id)
+
+        folder_checksum_indexes = ctx["folder_checksum_indexes"]
+        if folder_id not in folder_checksum_indexes:
+            folder_checksum_indexes[folder_id] = get_folder_checksum_index(
+                drive_service, folder_id, ctx["rate_limiter"]
+            )
+
+        if copy_list:
+            logger.info("> Copy the images of %s already on Google Drive", md_file)
+            copy_all_in_drive(
+                drive_service,
+                folder_id,
+                copy_list,
+                folder_checksum_indexes[folder_id],
+                args.credentials,
+                args.upload_workers,
+                ctx["rate_limiter"],
+            )
+
+        if args.stream:
+            logger.info("> Stream the images of %s to Google Drive", md_file)
+            stream_all_to_drive(
+                ctx["session"],
+                drive_service,
+                folder_id,
+                image_data_list,
+                folder_checksum_indexes[folder_id],
+                args.credentials,
+                args.upload_workers,
+                ctx["rate_limiter"],
+                ctx["retries"],
+                args.per_host,
             )
         else:
-            image_caption = os.path.splitext(os.path.basename(md_file))[0] + f"_{cnt}"
-        cnt += 1
+            logger.info("> Upload the downloaded images of %s to Google Drive", md_file)
+            errors = {}
+            new_urls = upload_all_to_drive(
+                drive_service,
+                folder_id,
+                [image_data["file_name"] for image_data in image_data_list],
+                [image_data["sha256"] for image_data in image_data_list],
+                folder_checksum_indexes[folder_id],
+                args.credentials,
+                args.upload_workers,
+                ctx["rate_limiter"],
+                [image_data["caption"] for image_data in image_data_list],
+                ledger,
+                errors,
+            )
+            for image_data, new_url in zip(image_data_list, new_urls):
+                if new_url is not None:
+                    image_data["file_id"] = new_url.rsplit("/", 1)[-1]
+                elif image_data["sha256"] in errors:
+                    image_data["error"] = errors[image_data["sha256"]]
+    finally:
+        release_pins(job, ctx)
+    image_data_list = image_data_list + copy_list
+    upload_failed = [
+        image_data for image_data in image_data_list if "file_id" not in image_data
+    ]
+    if upload_failed:
+        logger.warning(
+            "> %d image(s) of %s failed to upload", len(upload_failed), md_file
+        )
+        for image_data in upload_failed:
+            job["failed"][image_data["url"]] = image_data.get("error", "upload failed")
+        ledger_set_images(ledger, md_file, upload_failed, "failed", folder_id)
+        image_data_list = [
+            image_data for image_data in image_data_list if "file_id" in image_data
+        ]
+    ledger_set_images(ledger, md_file, image_data_list, "uploaded", folder_id)
+    job["image_data_list"] = image_data_list
+    return job
 
-        image_url: str = match[0]
-        if not image_url.startswith("http"):
-            continue
-        image_data = {"caption": image_caption, "url": image_url, "old_url": image_url}
-        print(image_data)
-        image_data_list.append(image_data)
 
-    return image_data_list
+def verify_stage(job, ctx):
+    """Checks that the new URLs of a markdown file resolve before they replace
+    the old ones; an image whose new URL does not keeps its old one.
 
-def download_image(file_name, image_url):
-    """Downloads an image from a URL and saves it to a file."""
-    try:
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            with open(file_name, "wb") as f:
-                f.write(response.content)
-                print("Downloaded", file_name)
+    Only an error answer counts: a new URL which cannot be checked, because
+    the host is unreachable or its circuit is open, is kept unverified.
+    """
+    args = ctx["args"]
+    md_file = job["md_file"]
+    new_urls = {
+        new_url(image_data["file_id"])
+        for image_data in job["image_data_list"] + job["uploaded_list"]
+    }
+    if not new_urls:
+        return job
+    logger.info("> Verify %d new URL(s) of %s", len(new_urls), md_file)
+    results = probe_all_urls(
+        ctx["session"], new_urls, args.download_workers, args.per_host, ctx["retries"]
+    )
+    broken = {
+        url.rsplit("/", 1)[-1]: describe_error(error)
+        for url, error in results.items()
+        if isinstance(error, DownloadError) and not is_transient(error)
+    }
+    unverified = sum(
+        error is not None and url.rsplit("/", 1)[-1] not in broken
+        for url, error in results.items()
+    )
+    ok = len(results) - len(broken) - unverified
+    METRICS.count("images", ok, stage="verify", outcome="ok")
+    METRICS.count("images", len(broken), stage="verify", outcome="broken")
+    METRICS.count("images", unverified, stage="verify", outcome="unverified")
+    if unverified:
+        logger.warning(
+            "> %d new URL(s) of %s cannot be checked; keep them", unverified, md_file
+        )
+    if not broken:
+        return job
+    logger.warning("> %d new URL(s) of %s do not resolve", len(broken), md_file)
+    broken_list = []
+    for key in ("image_data_list", "uploaded_list"):
+        kept = []
+        for image_data in job[key]:
+            if image_data["file_id"] in broken:
+                broken_list.append(image_data)
+                reason = broken[image_data["file_id"]]
+                job["failed"][image_data["url"]] = f"new URL {reason}"
+            else:
+                kept.append(image_data)
+        job[key] = kept
+    ledger_set_images(ctx["ledger"], md_file, broken_list, "failed")
+    return job
+
+
+def defer(job, ctx, outcome, error=None):
+    """Records why a markdown file is not done, and queues it for another try
+    at the end of the run while deferred rounds remain."""
+    md_file = job["md_file"]
+    if error is not None:
+        ctx["failures"][md_file] = {None: describe_error(error)}
+    elif job["failed"]:
+        ctx["failures"][md_file] = job["failed"]
+    else:
+        METRICS.count("md_files", outcome=outcome)
+        return
+    if ctx["deferred"] is not None:
+        ctx["deferred"].append(md_file)
+        METRICS.count("md_files", outcome="deferred")
+    else:
+        METRICS.count("md_files", outcome=outcome)
+
+
+def rewrite_stage(job, ctx):
+    """Replaces the old URLs of a markdown file once all its images are done."""
+    ledger = ctx["ledger"]
+    md_file = job["md_file"]
+    image_data_list = job["image_data_list"] + job["uploaded_list"]
+    if len(image_data_list) == 0:
+        logger.info("> No image of %s transferred; keep the file as is", md_file)
+        defer(job, ctx, "untouched")
+        return job
+
+    logger.info("> Replace old URLs with new URLs in %s", md_file)
+    old_urls = [image_data.get("old_url") for image_data in image_data_list]
+    new_urls = [new_url(image_data["file_id"]) for image_data in image_data_list]
+    pool = ctx.get("md_pool")
+    if pool is None:
+        with METRICS.timer("rewrite"):
+            changed = replace_urls_in_md(old_urls, new_urls, md_file)
+        finish_rewrite(job, ctx, image_data_list, changed)
+        return job
+
+    # the regex work runs on the process pool while this stage goes on with
+    # the next files; the job is finished when the worker is done
+    done = threading.Event()
+    start = time.perf_counter()
+
+    def callback(future):
+        METRICS.observe("stage_seconds", time.perf_counter() - start, stage="rewrite")
+        try:
+            changed = future.result()
+        except Exception as error:
+            logger.error(
+                "An error occurred in rewrite_stage for %s: %s", md_file, error
+            )
+            defer(job, ctx, "error", error)
         else:
-            print(image_url)
-            raise HttpError("Failed to download", image_url)
+            finish_rewrite(job, ctx, image_data_list, changed)
+        finally:
+            done.set()
 
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
+    ctx["rewrites"].append(done)
+    pool.submit(replace_urls_in_md, old_urls, new_urls, md_file).add_done_callback(
+        callback
+    )
+    return job
 
 
-def get_file_id_if_exist(drive_service, folder_id, file_name) -> str:
-    # Ref: https://developers.google.com/drive/api/guides/search-files?hl=en#specific
-    # we use sha256 Checksum to compare local file and the remote file
-    try:
-        page_token = None
+def finish_rewrite(job, ctx, image_data_list, changed):
+    """Records a markdown file as done once its URLs are replaced."""
+    ledger = ctx["ledger"]
+    md_file = job["md_file"]
+    if changed:
+        METRICS.count("bytes", os.path.getsize(md_file), stage="rewrite")
+        logger.info("Markdown file %s updated with new URLs.", md_file)
+    else:
+        logger.info("Markdown file %s already up to date.", md_file)
+    ledger_set_images(ledger, md_file, image_data_list, "rewritten")
+    if job["failed"]:
+        logger.warning(
+            "> %d image(s) of %s keep their old URLs", len(job["failed"]), md_file
+        )
+        defer(job, ctx, "partial")
+    else:
+        ledger_set_md(ledger, md_file, "done")
+        ledger_set_manifest(ledger, md_file)
+        METRICS.count("md_files", outcome="done")
+
+
+def run_pipeline(jobs, stages, queue_size=2, on_error=None):
+    """Passes the jobs through the stages like a production line.
+
+    Every stage runs on its own thread and hands its jobs to the next stage
+    through a bounded queue, so a stage can work on the next job while the
+    following stages still work on the previous ones. A job whose stage raises
+    is reported, handed to `on_error(job, error)` if given, and dropped without
+    stopping the others.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    done = object()  # marks the end of the jobs
+
+    def run_stage(stage, in_queue, out_queue):
         while True:
-            response = (
-                drive_service.files()
-                .list(
-                    q=f"'{folder_id}' in parents",
-                    spaces="drive",
-                    fields="nextPageToken, files(id, sha256Checksum)",
-                    pageToken=page_token,
+            job = in_queue.get()
+            if job is done:
+                break
+            start = time.perf_counter()
+            try:
+                job = stage(job)
+            except Exception as error:
+                logger.error(
+                    "An error occurred in %s for %s: %s",
+                    stage.func.__name__,
+                    job["md_file"],
+                    error,
                 )
-                .execute()
-            )
-            files = response.get("files", [])
+                if on_error is not None:
+                    on_error(job, error)
+                else:
+                    METRICS.count("md_files", outcome="error")
+                continue
+            finally:
+                METRICS.observe(
+                    "job_seconds",
+                    time.perf_counter() - start,
+                    stage=stage.func.__name__,
+                )
+            if out_queue is not None:
+                out_queue.put(job)
+        if out_queue is not None:
+            out_queue.put(done)
 
-            for file in files:
-                if hashlib.sha256(open(file_name, "rb").read()).hexdigest() == file.get(
-                    "sha256Checksum"
-                ):
-                    print(
-                        f"File '{file_name}' already exists with ID {file.get('id')}."
-                    )
-                    return file.get("id")
-            files.extend(response.get("files", []))
-            page_token = response.get("nextPageToken", None)
-            if page_token is None:
-                break
-        return None
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
+    threads = [
+        threading.Thread(
+            target=run_stage,
+            args=(stage, in_queue, out_queue),
+            daemon=True,
+        )
+        for stage, in_queue, out_queue in zip(stages, queues, queues[1:] + [None])
+    ]
+    for thread in threads:
+        thread.start()
+    for job in jobs:
+        queues[0].put(job)
+    queues[0].put(done)
+    for thread in threads:
+        thread.join()
 
 
-def upload_one_to_drive(drive_service, folder_id, file_name) -> str:
-    file_metadata = {
-        "name": os.path.splitext(os.path.basename(file_name))[0],
-        "parents": [folder_id],
-    }
-    media = MediaFileUpload(file_name, resumable=True)
+def wait_rewrites(ctx):
+    """Waits for the rewrites still running on the process pool."""
+    for done in ctx["rewrites"]:
+        done.wait()
+    ctx["rewrites"].clear()
 
-    file = (
-        drive_service.files()
-        .create(body=file_metadata, media_body=media, fields="id")
-        .execute()
-    )
-    print(f"File '{file_name}' created with ID {file.get('id')}.")
-    return file.get("id")
+
+def make_stages(ctx):
+    """Returns the pipeline stages of the run, bound to its context."""
+    args = ctx["args"]
+    stages = []
+    if args.probe:
+        stages.append(functools.partial(probe_stage, ctx=ctx))
+    stages.append(functools.partial(download_stage, ctx=ctx))
+    if args.optimize:
+        stages.append(functools.partial(optimize_stage, ctx=ctx))
+    stages.append(functools.partial(upload_stage, ctx=ctx))
+    if args.probe:
+        stages.append(functools.partial(verify_stage, ctx=ctx))
+    stages.append(functools.partial(rewrite_stage, ctx=ctx))
+    return stages
 
 
-def upload_all_to_drive(drive_service, folder_id, file_names):
+def transfer_jobs(pending, ctx, stages, md_pool=None):
+    """Creates the missing folders of the jobs and passes them through the
+    stages, then tries the deferred markdown files again and logs the
+    failures left."""
+    args, ledger, retries = ctx["args"], ctx["ledger"], ctx["retries"]
+    logger.info("> Create folders")
+    drive_service = get_drive_service(args.credentials)
     try:
-        new_urls = []
-        for file_name in file_names:
-            file_id = get_file_id_if_exist(drive_service, folder_id, file_name)
-            if file_id is None:
-                file_id = upload_one_to_drive(drive_service, folder_id, file_name)
-            new_urls.append(f"https://lh3.googleusercontent.com/d/{file_id}")
-        return new_urls
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
+        if ctx["folder_index"] is None:
+            ctx["folder_index"] = get_folder_index(
+                drive_service, ctx["root_id"], ctx["rate_limiter"]
+            )
+    except Exception as error:
+        # upload_stage lists them for each file, which is deferred on failure
+        logger.error("Cannot list the folders: %s", describe_error(error))
+    folder_index = ctx["folder_index"]
+    if folder_index is not None:
+        existing_folders = set(folder_index)
+        create_folders(
+            drive_service,
+            [
+                folder_name_of(job["md_file"])
+                for job in pending
+                if job["image_data_list"]
+            ],
+            ctx["root_id"],
+            folder_index,
+            ctx["rate_limiter"],
+        )
+        # folders created now are empty, no need to list them
+        for folder_name, folder_id in folder_index.items():
+            if folder_name not in existing_folders:
+                ctx["folder_checksum_indexes"][folder_id] = {}
 
+    # markdown files to try again at the end of the run, if any round left
+    ctx["deferred"] = [] if args.deferred_rounds > 0 else None
+    ctx["failures"] = {}
+    # markdown files are rewritten on the process pool for large runs
+    ctx["md_pool"] = md_pool if len(pending) >= MD_POOL_MIN_FILES else None
 
-# Replace old URLs with new URLs in Markdown file
-def replace_urls_in_md(old_urls, new_urls, md_file):
-    with open(md_file, "r") as f:
-        md_content = f.read()
+    def on_error(job, error):
+        release_pins(job, ctx)
+        defer(job, ctx, "error", error)
+
+    run_pipeline(pending, stages, args.queue_size, on_error)
+    wait_rewrites(ctx)
+    for round_idx in range(args.deferred_rounds):
+        deferred = ctx["deferred"]
+        if not deferred:
+            break
+        logger.info(
+            "> Retry %d deferred markdown file(s), round %d/%d",
+            len(deferred),
+            round_idx + 1,
+            args.deferred_rounds,
+        )
+        ctx["deferred"] = [] if round_idx + 1 < args.deferred_rounds else None
+        for md_file in deferred:
+            ctx["failures"].pop(md_file, None)
+        # give the hosts whose circuit opened a new chance
+        retries.reset_breakers()
+        run_pipeline(
+            prepare_jobs(ledger, deferred, args.hackmd, md_pool, args.md_workers),
+            stages,
+            args.queue_size,
+            on_error,
+        )
+        wait_rewrites(ctx)
+    log_failure_summary(ctx["failures"])
 
-    for old_url, new_url in zip(old_urls, new_urls):
-        md_content = md_content.replace(old_url, new_url)
 
-    with open(md_file, "w") as f:
-        f.write(md_content)
-        print(f"Markdown file {md_file} updated with new URLs.")
+def watch_md_files(watcher, ctx, stages, md_pool=None, total_files=0):
+    """Migrates the markdown files created or changed under the watched
+    directory with the warm context of the run, until SIGINT or SIGTERM."""
+    args, ledger = ctx["args"], ctx["ledger"]
+    stop = threading.Event()
 
+    def handle_signal(signum, frame):
+        logger.info("Stop watching once the current batch is done")
+        stop.set()
 
-def build_drive_service(credentials_file):
-    try:
-        with open(credentials_file, "r") as f:
-            credentials = json.load(f)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials, scopes=["https://www.googleapis.com/auth/drive"]
+    def is_done(md_file):
+        try:
+            return ledger_is_md_unchanged(ledger, md_file, os.stat(md_file))
+        except FileNotFoundError:  # removed since the poll
+            return True
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handle_signal)
+    logger.info("Watch %s for changes every %ss", watcher.root, args.watch_interval)
+    while not stop.wait(args.watch_interval):
+        md_files = watcher.poll()
+        if args.shard is not None:
+            md_files = select_shard(md_files, args.shard)
+        # our own rewrites show up as changes too
+        md_files = [md_file for md_file in md_files if not is_done(md_file)]
+        if not md_files:
+            continue
+        logger.info("> %d markdown file(s) changed", len(md_files))
+        total_files += len(md_files)
+        run_id = ledger_start_run(ledger, md_files)
+        pending = prepare_jobs(ledger, md_files, args.hackmd, md_pool, args.md_workers)
+        if pending:
+            transfer_jobs(pending, ctx, stages, md_pool)
+        ledger_finish_run(ledger, run_id)
+        logger.info("Done: %s", progress_line(total_files))
+        write_metrics(args)
+    logger.info("Stopped watching %s", watcher.root)
+
+
+def write_metrics(args):
+    if args.metrics_json is not None:
+        write_file_atomically(
+            args.metrics_json, json.dumps(METRICS.summary(), indent=2) + "\n"
         )
-        drive_service = build("drive", "v3", credentials=credentials)
-        return drive_service
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
+    if args.metrics_prom is not None:
+        write_file_atomically(args.metrics_prom, METRICS.to_prometheus())
 
 
-def get_folder_id_if_exist(drive_service, folder_name, parent_id):
-    # Ref: https://developers.google.com/drive/api/guides/search-files?hl=en#specific
-    try:
-        page_token = None
-        while True:
-            response = (
-                drive_service.files()
-                .list(
-                    q=f"mimeType = 'application/vnd.google-apps.folder' and '{parent_id}' in parents",
-                    spaces="drive",
-                    fields="nextPageToken, files(id, name)",
-                    pageToken=page_token,
-                )
-                .execute()
-            )
-            folders = response.get("files", [])
+def progress_line(total_files) -> str:
+    # files deferred to the end of the run are counted again once retried
+    done = METRICS.total("md_files") - METRICS.total("md_files", outcome="deferred")
+    images = METRICS.total("images", stage="upload") + METRICS.total(
+        "images", stage="copy"
+    )
+    elapsed = time.time() - METRICS.started_at
+    return (
+        f"{done}/{total_files} markdown file(s), {images} image(s)"
+        f" ({images / max(elapsed, 1e-9):.1f}/s),"
+        f" {METRICS.total('bytes', stage='download') / 2**20:.1f} MiB down,"
+        f" {METRICS.total('bytes', stage='upload') / 2**20:.1f} MiB up,"
+        f" {METRICS.total('api_calls')} API call(s),"
+        f" {METRICS.total('retries')} retry(ies)"
+    )
 
-            for folder in folders:
-                if folder_name == folder.get("name"):
-                    print(
-                        f"Folder '{folder_name}' already exists with ID {folder.get('id')}."
-                    )
-                    return folder.get("id")
-            folders.extend(response.get("files", []))
-            page_token = response.get("nextPageToken", None)
-            if page_token is None:
-                break
-        return None
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
 
+def start_progress(total_files, interval=1.0):
+    """Keeps a live progress line on stderr until the returned event is set."""
+    stop = threading.Event()
 
-def get_or_create_folder(drive_service, folder_name, parent_id):
-    folder_id = get_folder_id_if_exist(drive_service, folder_name, parent_id)
-    if folder_id is not None:
-        return folder_id
+    def run():
+        while not stop.wait(interval):
+            sys.stderr.write("\r" + progress_line(total_files))
+            sys.stderr.flush()
+        sys.stderr.write("\r" + progress_line(total_files) + "\n")
 
-    try:
-        # Create one
-        folder_metadata = {
-            "name": folder_name,
-            "mimeType": "application/vnd.google-apps.folder",
-            "parents": [parent_id],
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return stop, thread
+
+
+def log_failure_summary(failures):
+    """Logs the images left behind by the run, grouped by host and reason."""
+    groups = {}
+    for md_file, failed in failures.items():
+        for image_url, reason in failed.items():
+            host = urlsplit(image_url).netloc if image_url else "(markdown file)"
+            groups.setdefault((host, reason), []).append(image_url or md_file)
+    if not groups:
+        return
+    logger.warning("%d markdown file(s) left with failures:", len(failures))
+    for (host, reason), items in sorted(
+        groups.items(), key=lambda group: -len(group[1])
+    ):
+        logger.warning("  %s: %s x%d, e.g. %s", host, reason, len(items), items[0])
+
+
+def prepare_jobs(ledger, md_files, hackmd=False, pool=None, workers=1) -> list:
+    """Finds the images left to transfer in the markdown files.
+
+    Returns one job per markdown file with work to do; the files unchanged
+    since they were done, without image, or whose images were all migrated
+    by earlier runs are skipped. The files are parsed on the process `pool`
+    if given, see extract_all_md_files().
+    """
+    candidates = []
+    for idx, md_file in enumerate(md_files):
+        # if "ouo" in md_file: # file to be skip
+        #     continue
+        try:
+            stat = os.stat(md_file)
+        except FileNotFoundError:
+            logger.warning("Skip #%d %s (not found)", idx + 1, md_file)
+            METRICS.count("md_files", outcome="missing")
+            continue
+        if ledger_is_md_unchanged(ledger, md_file, stat):
+            logger.info("Skip #%d %s (unchanged since done)", idx + 1, md_file)
+            METRICS.count("md_files", outcome="skipped")
+            continue
+        candidates.append((idx, md_file, stat))
+
+    with METRICS.timer("extract"):
+        image_data_lists = extract_all_md_files(
+            [md_file for _, md_file, _ in candidates], hackmd, pool, workers
+        )
+    jobs = []
+    for (idx, md_file, stat), image_data_list in zip(candidates, image_data_lists):
+        METRICS.count("images", len(image_data_list), stage="extract", outcome="found")
+
+        if len(image_data_list) == 0:
+            logger.info("Skip #%d %s (no image found)", idx + 1, md_file)
+            METRICS.count("md_files", outcome="no_image")
+            ledger_set_md(ledger, md_file, "done")
+            ledger_set_manifest(ledger, md_file, stat)
+            continue
+        ledger_set_md(ledger, md_file, "pending")
+
+        # images uploaded by an earlier run need neither download nor upload
+        recorded = ledger_get_images(ledger, md_file)
+        migrated_urls = {
+            new_url(record["file_id"])
+            for record in recorded.values()
+            if record["file_id"] is not None
         }
-        folder = (
-            drive_service.files().create(body=folder_metadata, fields="id").execute()
+        image_data_list = [
+            image_data
+            for image_data in image_data_list
+            if image_data["old_url"] not in migrated_urls
+        ]
+        for image_data in image_data_list:
+            record = recorded.get(image_data["old_url"])
+            if record is not None and record["file_id"] is not None:
+                image_data["sha256"] = record["sha256"]
+                image_data["file_id"] = record["file_id"]
+        uploaded_list = [
+            image_data for image_data in image_data_list if "file_id" in image_data
+        ]
+        image_data_list = [
+            image_data for image_data in image_data_list if "file_id" not in image_data
+        ]
+        if not image_data_list and not uploaded_list:
+            logger.info("Skip #%d %s (all images migrated)", idx + 1, md_file)
+            METRICS.count("md_files", outcome="skipped")
+            ledger_set_md(ledger, md_file, "done")
+            ledger_set_manifest(ledger, md_file, stat)
+            continue
+        jobs.append(
+            {
+                "idx": idx,
+                "md_file": md_file,
+                "image_data_list": image_data_list,
+                "uploaded_list": uploaded_list,
+                "failed": {},
+            }
         )
-        print(f"Folder '{folder_name}' created with ID {folder.get('id')}.")
-        return folder.get("id")
-    except HttpError as error:
-        print(f"An error occurred: {error}")
-        raise
+    return jobs
 
 
 def main():
@@ -310,7 +3242,10 @@ def main():
         description="Download images from a markdown file and upload them to Google Drive."
     )
     parser.add_argument(
-        "credentials", type=str, help="Path to the service account credentials file."
+        "credentials",
+        type=str,
+        nargs="?",
+        help="Path to the service account credentials file.",
     )
     parser.add_argument("-f", "--md-file", type=str, help="Path to the markdown file.")
     parser.add_argument(
@@ -319,65 +3254,375 @@ def main():
         type=str,
         help="Path to the directory which contains markdown files.",
     )
+    parser.add_argument(
+        "--include",
+        action="append",
+        help="Only take the files matching this pattern under --dir (*.md by"
+        " default); patterns with a / match the path relative to --dir.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        help="Skip the files and directories matching this pattern under --dir,"
+        f" besides {', '.join(DEFAULT_EXCLUDES)}.",
+    )
     parser.add_argument(
         "--hackmd",
         help="For processing imgur images for HackMD",
         action='store_true'
     )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="Number of images downloaded at the same time.",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=4,
+        help="Maximum concurrent downloads from the same host.",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=8,
+        help="Maximum number of images uploaded at the same time.",
+    )
+    parser.add_argument(
+        "--drive-qps",
+        type=float,
+        default=10,
+        help="Maximum Google Drive requests per second for uploads.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Retries of a download or Drive request failing with a transient"
+        " error, with a jittered exponential backoff.",
+    )
+    parser.add_argument(
+        "--breaker-threshold",
+        type=int,
+        default=5,
+        help="Failures in a row after which the requests to a host are paused.",
+    )
+    parser.add_argument(
+        "--breaker-cooldown",
+        type=float,
+        default=60,
+        help="Seconds during which the requests to a failing host are paused.",
+    )
+    parser.add_argument(
+        "--deferred-rounds",
+        type=int,
+        default=1,
+        help="Times the markdown files left with failures are tried again at"
+        " the end of the run.",
+    )
+    parser.add_argument(
+        "--probe",
+        help="Check the source URLs with HEAD requests before downloading them,"
+        " and the new URLs before writing them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dead-link-ttl",
+        type=float,
+        default=7 * 24 * 60 * 60,
+        help="Seconds during which a source URL found dead by --probe is skipped"
+        " without asking its host again.",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Stream images from their hosts into Google Drive without"
+        " writing them to disk",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.path.join(".cache", "images"),
+        help="Directory of the downloaded images shared by all runs.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="Disk budget of the image cache in MiB.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=24 * 60 * 60,
+        help="Seconds during which a cached image is used without asking its"
+        " host; after that, it is revalidated with ETag/Last-Modified.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="Number of markdown files waiting between two pipeline stages.",
+    )
+    parser.add_argument(
+        "--ledger",
+        type=str,
+        default="transfer.sqlite3",
+        help="Path to the SQLite ledger which records the transfer progress.",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue the markdown files left unfinished by the last run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report",
+        help="Print the progress recorded in the ledger and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="i/N",
+        help="Only handle the i-th of N deterministic shards of the markdown"
+        " files; the ledger defaults to transfer.shard-i-of-N.sqlite3.",
+    )
+    parser.add_argument(
+        "--merge",
+        type=str,
+        nargs="+",
+        metavar="LEDGER",
+        help="Merge the ledgers of shards into --ledger and exit.",
+    )
+    parser.add_argument(
+        "--watch",
+        help="Keep running after the first pass and migrate the markdown files"
+        " created or changed under --dir",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=2,
+        help="Seconds between two scans of --dir in watch mode.",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=2,
+        help="Seconds a changed markdown file must stay untouched before it is"
+        " migrated in watch mode.",
+    )
+    parser.add_argument(
+        "--optimize",
+        help="Recompress the downloaded images without their metadata before"
+        " uploading them (needs Pillow)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=sorted(OPTIMIZED_FORMATS),
+        help="Convert the optimized images to this format.",
+    )
+    parser.add_argument(
+        "--max-dimension",
+        type=int,
+        help="Downscale the optimized images to fit in this many pixels.",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=85,
+        help="Quality of the optimized JPEG/WebP/AVIF images.",
+    )
+    parser.add_argument(
+        "--optimize-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes optimizing images.",
+    )
+    parser.add_argument(
+        "--md-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes parsing and rewriting the markdown files"
+        f" when there are at least {MD_POOL_MIN_FILES} of them.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Log every image and Drive file, not only every markdown file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-q", "--quiet", help="Only log warnings and errors", action="store_true"
+    )
+    parser.add_argument(
+        "--log-json", help="Log one JSON object per line", action="store_true"
+    )
+    parser.add_argument(
+        "--progress",
+        help="Keep a live progress line on stderr (best with --quiet)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        help="Write a JSON summary of the run metrics to this file.",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        type=str,
+        help="Write the run metrics to this Prometheus textfile.",
+    )
     args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.stdout)
+    if args.log_json:
+        handler.setFormatter(JSONLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.quiet:
+        level = logging.WARNING
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    # keep the libraries at INFO when we log at DEBUG
+    logging.getLogger().setLevel(max(level, logging.INFO))
+    logger.setLevel(level)
+    METRICS.reset()
+
+    if args.optimize:
+        if args.stream:
+            parser.error("--optimize cannot be used with --stream")
+        if Image is None:
+            parser.error("--optimize needs Pillow: pip install Pillow")
+        if args.image_format is not None and not features.check(args.image_format):
+            parser.error(f"Pillow cannot write {args.image_format} images here")
+
+    if args.shard is not None and args.ledger == parser.get_default("ledger"):
+        args.ledger = "transfer.shard-{}-of-{}.sqlite3".format(*args.shard)
+    ledger = open_ledger(args.ledger)
+    if args.merge:
+        for other_file in args.merge:
+            ledger_merge(ledger, other_file)
+            logger.info("Merged %s into %s", other_file, args.ledger)
+        print_ledger_report(ledger)
+        return
+    if args.report:
+        print_ledger_report(ledger)
+        return
+    if args.credentials is None:
+        parser.error("the following arguments are required: credentials")
+    if args.watch and args.dir is None:
+        parser.error("--watch needs --dir")
+
     # load .env file for root_id
     load_dotenv()
     root_id = os.getenv("root_id")
 
+    watcher = None
+    if args.watch:
+        # take the first snapshot before the first run, so that no save made
+        # during the run goes unnoticed
+        watcher = MarkdownWatcher(
+            args.dir,
+            args.include or ["*.md"],
+            list(DEFAULT_EXCLUDES) + (args.exclude or []),
+            args.debounce,
+        )
+
     md_files = []
+    if args.resume:
+        md_files.extend(ledger_last_run_files(ledger))
+
     if args.md_file is not None:
         md_files.append(args.md_file)
 
     if args.dir is not None:
-        md_files.extend(glob.glob(os.path.join(args.dir, "*.md"), recursive=True))
+        md_files.extend(
+            find_md_files(
+                args.dir,
+                args.include or ["*.md"],
+                list(DEFAULT_EXCLUDES) + (args.exclude or []),
+            )
+        )
 
-    print(f"Totel: {len(md_files)} markdown file(s)")
-    for idx, md_file in enumerate(md_files):
-        # if idx+1 <= 5: # used to continue process after solving issues during runtime
-        #     continue
-        # if "ouo" in md_file: # file to be skip
-        #     continue
-        print(f"\n\nProcess #{idx+1} {md_file}")
-        print("> Find all image links and captions in the markdown file")
-        if args.hackmd:
-            print("> HackMD mode (replace all imgur images)")
-            image_data_list = get_imgur_data_list_from_md(md_file)
-        else:
-            image_data_list = get_image_data_list_from_md(md_file)
-        
-        if len(image_data_list) == 0:
-            print("> No image found in this markdown file; go to next")
-            continue
-        
-        os.makedirs("tmp", exist_ok=True)
+    # --resume with -f/-r lists the unfinished files twice
+    md_files = list(dict.fromkeys(md_files))
+    if args.shard is not None:
+        md_files = select_shard(md_files, args.shard)
+        logger.info("Shard %d/%d", *args.shard)
 
-        print("> Download all images based on the URLs")
-        file_names = []
-        for image_data in image_data_list:
-            file_name = os.path.join("tmp/", image_data.get("caption"))
-            file_names.append(file_name)
-            if not os.path.exists(file_name):  # TODO: check if need redownload files
-                download_image(file_name, image_data.get("url"))
+    session = build_http_session(args.download_workers)
+    retries = RetryScheduler(
+        args.retries,
+        breaker_threshold=args.breaker_threshold,
+        breaker_cooldown=args.breaker_cooldown,
+    )
+    rate_limiter = DriveRateLimiter(
+        args.drive_qps, args.upload_workers, retries=retries
+    )
+    run_id = ledger_start_run(ledger, md_files)
+    if args.progress:
+        progress = start_progress(len(md_files))
 
-        print("> Create folder")
-        folder_name = os.path.splitext(os.path.basename(md_file))[0]
-        drive_service = build_drive_service(args.credentials)
-        folder_id = get_or_create_folder(drive_service, folder_name, root_id)
+    logger.info("Totel: %d markdown file(s)", len(md_files))
+    logger.info("> Find all image links and captions in the markdown files")
+    if args.hackmd:
+        logger.info("> HackMD mode (replace all imgur images)")
+    md_pool = None
+    if args.md_workers > 1 and (args.watch or len(md_files) >= MD_POOL_MIN_FILES):
+        # spawn rather than fork the workers from a threaded process
+        md_pool = ProcessPoolExecutor(
+            args.md_workers, multiprocessing.get_context("spawn")
+        )
+    pending = prepare_jobs(ledger, md_files, args.hackmd, md_pool, args.md_workers)
 
-        print("> Upload the downloaded images to Google Drive")
-        new_urls = upload_all_to_drive(drive_service, folder_id, file_names)
+    ctx = None
+    if pending or watcher is not None:
+        # everything here stays warm between the batches of the watch mode
+        ctx = {
+            "args": args,
+            "ledger": ledger,
+            "session": session,
+            "rate_limiter": rate_limiter,
+            "retries": retries,
+            "cache": ImageCache(args.cache_dir, args.cache_size * 2**20),
+            "root_id": root_id,
+            "folder_index": None,  # listed on first use
+            "folder_checksum_indexes": {},
+            "rewrites": [],
+        }
+        if args.optimize:
+            # spawn rather than fork the workers from a threaded process
+            ctx["process_pool"] = ProcessPoolExecutor(
+                args.optimize_workers, multiprocessing.get_context("spawn")
+            )
+            ctx["optimize_options"] = {
+                "image_format": args.image_format,
+                "max_dimension": args.max_dimension,
+                "quality": args.quality,
+            }
+        stages = make_stages(ctx)
+    if pending:
+        transfer_jobs(pending, ctx, stages, md_pool)
 
-        print("> Replace old URLs with new URLs in Markdown file")
-        old_urls = [image_data.get("old_url") for image_data in image_data_list]
-        replace_urls_in_md(old_urls, new_urls, md_file)
+    ledger_finish_run(ledger, run_id)
+    if args.progress:
+        progress[0].set()
+        progress[1].join()
+    logger.info("Done: %s", progress_line(len(md_files)))
+    write_metrics(args)
 
-        # Delete all temporary files
-        # shutil.rmtree("tmp") # TODO: delete downloaded files
+    if watcher is not None:
+        watch_md_files(watcher, ctx, stages, md_pool, len(md_files))
+    if ctx is not None and args.optimize:
+        ctx["process_pool"].shutdown()
+    if md_pool is not None:
+        md_pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""
+Tests of the circuit breakers and the retry scheduler.
+
+    $ python -m unittest discover python/tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from img_host_transfer import (  # noqa: E402
+    CircuitBreaker,
+    CircuitOpenError,
+    DownloadError,
+    RetryScheduler,
+)
+
+COOLDOWN = 0.05
+
+
+def open_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=COOLDOWN)
+    breaker.failure()
+    assert breaker.failure()
+    return breaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold_failures_in_a_row(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=COOLDOWN)
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        breaker.success()
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+
+    def test_lets_one_trial_call_through_after_cooldown(self):
+        breaker = open_breaker()
+        time.sleep(COOLDOWN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_successful_trial_closes(self):
+        breaker = open_breaker()
+        time.sleep(COOLDOWN)
+        breaker.allow()
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = open_breaker()
+        time.sleep(COOLDOWN)
+        breaker.allow()
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+        time.sleep(COOLDOWN)
+        self.assertTrue(breaker.allow())
+
+    def test_throttled_trial_reopens(self):
+        breaker = open_breaker()
+        time.sleep(COOLDOWN)
+        breaker.allow()
+        breaker.throttled()
+        self.assertFalse(breaker.allow())
+        time.sleep(COOLDOWN)
+        self.assertTrue(breaker.allow())
+
+    def test_throttled_leaves_closed_circuit_alone(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=COOLDOWN)
+        breaker.failure()
+        breaker.throttled()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure())
+
+
+class RetrySchedulerTest(unittest.TestCase):
+    def make_calls(self, *outcomes):
+        """Returns a function failing with, or returning, each outcome in turn."""
+        outcomes = list(outcomes)
+
+        def function():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return function
+
+    def test_retries_transient_errors(self):
+        retries = RetryScheduler(max_retries=2, base_delay=0.001)
+        function = self.make_calls(DownloadError("u", 503), DownloadError("u", 429), 1)
+        self.assertEqual(retries.call("host", function), 1)
+
+    def test_does_not_retry_other_errors(self):
+        retries = RetryScheduler(max_retries=2, base_delay=0.001)
+        function = self.make_calls(DownloadError("u", 404), 1)
+        with self.assertRaises(DownloadError):
+            retries.call("host", function)
+
+    def test_throttled_trial_does_not_stick_the_circuit_open(self):
+        retries = RetryScheduler(
+            max_retries=0, base_delay=0.001, breaker_threshold=2, breaker_cooldown=0.05
+        )
+        function = self.make_calls(
+            DownloadError("u", 500), DownloadError("u", 500), DownloadError("u", 429), 1
+        )
+        for _ in range(2):
+            with self.assertRaises(DownloadError):
+                retries.call("host", function)
+        with self.assertRaises(CircuitOpenError):
+            retries.call("host", function)
+        time.sleep(COOLDOWN)
+        with self.assertRaises(DownloadError):  # the trial call is throttled
+            retries.call("host", function)
+        with self.assertRaises(CircuitOpenError):
+            retries.call("host", function)
+        time.sleep(COOLDOWN)
+        self.assertEqual(retries.call("host", function), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
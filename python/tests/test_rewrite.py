@@ -0,0 +1,61 @@
+"""
+Tests of the rewrite of the URLs in markdown files.
+
+    $ python -m unittest discover python/tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import img_host_transfer  # noqa: E402
+from img_host_transfer import replace_urls_in_md  # noqa: E402
+
+OLD_URL = "https://a.com/i.png"
+NEW_URL = "https://lh3.googleusercontent.com/d/new"
+
+
+class ReplaceUrlsTest(unittest.TestCase):
+    def rewrite(self, md_content):
+        """Rewrites OLD_URL in a file, read whole and through mmap; returns
+        the new content once both agree."""
+        contents = []
+        for mmap_threshold in (2**30, 0):
+            with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+                img_host_transfer, "MMAP_THRESHOLD", mmap_threshold
+            ):
+                md_file = os.path.join(directory, "post.md")
+                with open(md_file, "w", encoding="utf-8", newline="") as f:
+                    f.write(md_content)
+                replace_urls_in_md([OLD_URL], [NEW_URL], md_file)
+                with open(md_file, encoding="utf-8", newline="") as f:
+                    contents.append(f.read())
+        self.assertEqual(contents[0], contents[1])
+        return contents[0]
+
+    def test_rewrites_urls_followed_by_an_end(self):
+        for suffix in [")", '"', " x", "\n", "]", "|", "}", "`", "**", "\u00a0x"]:
+            with self.subTest(suffix=suffix):
+                self.assertEqual(
+                    self.rewrite(f"see {OLD_URL}{suffix}"), f"see {NEW_URL}{suffix}"
+                )
+
+    def test_rewrites_urls_followed_by_punctuation(self):
+        for suffix in [",", ".", ". Next", "; x", "...", "?", "!)", ".\u3000"]:
+            with self.subTest(suffix=suffix):
+                self.assertEqual(
+                    self.rewrite(f"see {OLD_URL}{suffix}"), f"see {NEW_URL}{suffix}"
+                )
+
+    def test_keeps_longer_urls(self):
+        for suffix in ["?x=1", ".bak", "2", "/x", "#a", "_2", "-2", ",b", "..x", "é"]:
+            with self.subTest(suffix=suffix):
+                md_content = f"see {OLD_URL}{suffix}"
+                self.assertEqual(self.rewrite(md_content), md_content)
+
+
+if __name__ == "__main__":
+    unittest.main()